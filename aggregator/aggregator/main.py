@@ -1,11 +1,25 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel
+from typing import List, Optional
 import uvicorn
 import os
 import sys
-import requests
-from requests.exceptions import Timeout
+import httpx
+import asyncio
+import contextlib
 import datetime
+import json
+import time
+import hashlib
+import re
+import zlib
+import tempfile
+try:
+    # zstd圧縮。インストールされていない場合はgzipのみで応答する
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # stdout, stderr, stdinのバッファリングを設定
 sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', buffering=1)
@@ -14,103 +28,1575 @@ sys.stdin = os.fdopen(sys.stdin.fileno(), 'r', buffering=1)
 
 app = FastAPI()
 
+# k8sクラスタの接続情報(configmapから生成されたファイル)のパス
+# APIサーバの証明書はK8S_CLUSTER_CA_PATHのCAで検証する(ファイルが無い場合は接続しない)
+k8s_cluster_token_path = os.environ.get(
+    'K8S_CLUSTER_TOKEN_PATH', '/tmp/k8sClusterToken')
+k8s_cluster_address_path = os.environ.get(
+    'K8S_CLUSTER_ADDRESS_PATH', '/tmp/k8sClusterIPaddress')
+k8s_cluster_ca_path = os.environ.get(
+    'K8S_CLUSTER_CA_PATH', '/tmp/k8sClusterCA')
+# AGGREGATOR_INSECURE_SKIP_VERIFY: trueの場合、CAのファイルが無ければ証明書を検証せずに接続する
+#   (検証用のクラスタ向け。本番環境では使わない)
+aggregator_insecure_skip_verify = os.environ.get(
+    'AGGREGATOR_INSECURE_SKIP_VERIFY', 'false').lower() == 'true'
+# APIサーバへのkeep-alive接続を保持するコネクションプールのサイズ
+aggregator_pool_size = int(os.environ.get('AGGREGATOR_POOL_SIZE', '10'))
+# APIサーバ(エンドポイント)ごとに同時に実行するLISTの数(WATCHは含まない)
+aggregator_upstream_concurrency = int(os.environ.get(
+    'AGGREGATOR_UPSTREAM_CONCURRENCY', str(aggregator_pool_size)))
+# LISTを分割して取得する際の1ページの件数(0の場合は分割しない)と1ページごとのタイムアウト(秒)
+aggregator_page_size = int(os.environ.get('AGGREGATOR_PAGE_SIZE', '500'))
+aggregator_page_timeout = float(
+    os.environ.get('AGGREGATOR_PAGE_TIMEOUT', '10.0'))
+# 複数ページのLISTにETagを付与する場合、全ページを書き出してから応答する。
+# その際にメモリ上に保持する最大サイズ(byte)。超えると一時ファイルを使う
+aggregator_spool_max_size = int(os.environ.get(
+    'AGGREGATOR_SPOOL_MAX_SIZE', str(8 * 1024 * 1024)))
 
-def get_api_version_and_resource_type(kind):
+# LIST+WATCHによるリソースのキャッシュの設定
+# AGGREGATOR_CACHE: trueの場合、(kind, namespace)ごとにキャッシュを作成し、キャッシュから応答する
+# AGGREGATOR_CACHE_RESYNC: キャッシュをLISTで取得し直す間隔(秒)
+# AGGREGATOR_CACHE_IDLE: この秒数の間使われなかったキャッシュは削除する(WATCHも止める)
+# AGGREGATOR_CACHE_MAX: 保持するキャッシュの最大数。超えた場合は最も長く使われていないものを削除する
+# AGGREGATOR_CACHE_WATCH_INTERVAL: WATCHを張り直す最短の間隔(秒)。
+#   WATCHがこれより早く終了した場合は待ってから張り直し、続く場合は待ち時間を倍にする
+# AGGREGATOR_CACHE_WATCH_BACKOFF_MAX: WATCHを張り直すまでの最大の待ち時間(秒)
+aggregator_cache = os.environ.get(
+    'AGGREGATOR_CACHE', 'false').lower() == 'true'
+aggregator_cache_resync = float(
+    os.environ.get('AGGREGATOR_CACHE_RESYNC', '3600'))
+aggregator_cache_idle = float(
+    os.environ.get('AGGREGATOR_CACHE_IDLE', '7200'))
+aggregator_cache_max = int(os.environ.get('AGGREGATOR_CACHE_MAX', '50'))
+aggregator_cache_watch_interval = float(
+    os.environ.get('AGGREGATOR_CACHE_WATCH_INTERVAL', '1'))
+aggregator_cache_watch_backoff_max = float(
+    os.environ.get('AGGREGATOR_CACHE_WATCH_BACKOFF_MAX', '30'))
+
+# APIサーバのディスカバリ(/api, /apis)によるkindの索引の設定
+# AGGREGATOR_DISCOVERY_TTL: 索引をバックグラウンドで取得し直す間隔(秒)
+# AGGREGATOR_DISCOVERY_MISS_INTERVAL: 未知のkindの場合に索引を取得し直す最短の間隔(秒)
+aggregator_discovery_ttl = float(
+    os.environ.get('AGGREGATOR_DISCOVERY_TTL', '600'))
+aggregator_discovery_miss_interval = float(
+    os.environ.get('AGGREGATOR_DISCOVERY_MISS_INTERVAL', '30'))
+
+# レスポンスの圧縮の設定
+# AGGREGATOR_COMPRESSION: 優先する順に並べた圧縮方式(zstd, gzip)。空の場合は圧縮しない
+#   クライアントのAccept-Encodingに含まれるもののうち、最も優先するものを使う
+# AGGREGATOR_GZIP_LEVEL, AGGREGATOR_ZSTD_LEVEL: 圧縮レベル(高いほどCPUを使い、小さくなる)
+# AGGREGATOR_COMPRESS_MIN_SIZE: これより小さいレスポンスは圧縮しない(byte)
+aggregator_compression = [
+    e.strip().lower() for e in
+    os.environ.get('AGGREGATOR_COMPRESSION', 'zstd,gzip').split(',')
+    if e.strip()]
+aggregator_gzip_level = int(os.environ.get('AGGREGATOR_GZIP_LEVEL', '5'))
+aggregator_zstd_level = int(os.environ.get('AGGREGATOR_ZSTD_LEVEL', '3'))
+aggregator_compress_min_size = int(
+    os.environ.get('AGGREGATOR_COMPRESS_MIN_SIZE', '1024'))
+
+# フィールドの射影(プロジェクション)の設定
+# AGGREGATOR_PROJECTION_DEFAULTS: kindごとのデフォルトで除外するフィールドのパス(json)
+#   "*"はすべてのkindに適用する。例: {"*": ["metadata.managedFields"], "Pod": ["status"]}
+aggregator_projection_defaults = json.loads(os.environ.get(
+    'AGGREGATOR_PROJECTION_DEFAULTS', json.dumps({
+        "*": [
+            "metadata.managedFields",
+            "metadata.annotations"
+            "['kubectl.kubernetes.io/last-applied-configuration']"
+        ]
+    })))
+
+# Listのmetadata.resourceVersionを取得するための正規表現(itemsより前のみを対象とする)
+LIST_RESOURCE_VERSION = re.compile(rb'"resourceVersion"\s*:\s*"([^"]*)"')
+
+
+class ClusterClient:
+    """
+    k8sクラスタのAPIサーバへ非同期にリクエストを送信するクラス
+
+    トークンとエンドポイントは一度だけ読み込み、ファイルが更新された場合のみ読み直す。
+    非同期HTTPクライアントはクラスタ(エンドポイント)ごとに保持し、keep-alive接続を再利用する。
+    LISTの同時実行数はエンドポイントごとにセマフォで制限する。
+
+    Attributes:
+    - token_path: トークンのファイルパス
+    - address_path: APIサーバのIPアドレス(またはFQDN):ポートのファイルパス
+    - ca_path: クラスタのCA証明書のファイルパス
+    - pool_size: コネクションプールのサイズ
+    - concurrency: エンドポイントごとのLISTの同時実行数
+    - insecure_skip_verify: CA証明書が無い場合に、証明書を検証せずに接続するか
+    """
+
+    def __init__(self, token_path, address_path, ca_path, pool_size,
+                 concurrency, insecure_skip_verify=False):
+        self.token_path = token_path
+        self.address_path = address_path
+        self.ca_path = ca_path
+        self.insecure_skip_verify = insecure_skip_verify
+        self.pool_size = pool_size
+        self.concurrency = concurrency
+        self.mtimes = None
+        self.token = None
+        self.base_url = None
+        self.verify = False
+        self.clients = {}
+        # WATCH用のクライアント(長時間接続を保持するため、LIST用のプールとは分ける)
+        self.watch_clients = {}
+        self.semaphores = {}
+
+    def file_mtimes(self):
+        """
+        接続情報のファイルの更新時刻を返す(存在しないファイルはNone)
+        """
+        mtimes = []
+        for path in (self.token_path, self.address_path, self.ca_path):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    async def reload(self):
+        """
+        接続情報のファイルが更新されていれば読み直す
+        """
+        mtimes = self.file_mtimes()
+        if mtimes == self.mtimes:
+            return
+
+        # configmapから生成されたファイルより、k8sクラスタのトークンを取得
+        with open(self.token_path) as f:
+            self.token = f.read().strip()
+
+        # configmapから生成されたファイルより、k8sクラスタのIPアドレスを取得
+        with open(self.address_path) as f:
+            k8sClusterIPaddress = f.read().strip()
+
+        # 取得したIPアドレスを元にベースURLを生成
+        self.base_url = "https://" + k8sClusterIPaddress + "/"
+
+        # CA証明書で検証する。無い場合は明示的に許可されたときのみ検証せずに接続する
+        # (空のディレクトリなどを誤ってCAとして扱わないよう、ファイルか確認する)
+        if os.path.isfile(self.ca_path):
+            self.verify = self.ca_path
+        elif self.insecure_skip_verify:
+            print("WARNING: CA file is not found. "
+                  "TLS verification is disabled.")
+            self.verify = False
+        else:
+            raise FileNotFoundError(
+                "CA file is not found. " + self.ca_path +
+                " (set AGGREGATOR_INSECURE_SKIP_VERIFY=true to skip "
+                "TLS verification)")
+
+        # 接続情報が変わったため、既存のクライアントは破棄する
+        clients = list(self.clients.values()) + \
+            list(self.watch_clients.values())
+        self.clients = {}
+        self.watch_clients = {}
+        self.mtimes = mtimes
+        print("cluster config is loaded. " + self.base_url)
+        for client in clients:
+            await client.aclose()
+
+    def client(self):
+        """
+        現在のクラスタ用の非同期HTTPクライアントを返す(無ければ作成する)
+        """
+        client = self.clients.get(self.base_url)
+        if client is None:
+            client = httpx.AsyncClient(
+                verify=self.verify,
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size))
+            self.clients[self.base_url] = client
+        return client
+
+    def watch_client(self):
+        """
+        現在のクラスタ用のWATCHの非同期HTTPクライアントを返す(無ければ作成する)
+        WATCHは1本ごとに接続を保持し続けるため、接続数の上限を設けない
+        (LIST用のプールを使うと、WATCHの数だけLISTが接続を待つことになる)
+        """
+        client = self.watch_clients.get(self.base_url)
+        if client is None:
+            client = httpx.AsyncClient(
+                verify=self.verify,
+                limits=httpx.Limits(
+                    max_connections=None,
+                    max_keepalive_connections=self.pool_size))
+            self.watch_clients[self.base_url] = client
+        return client
+
+    def semaphore(self):
+        """
+        現在のクラスタ用のLISTの同時実行数を制限するセマフォを返す
+        """
+        semaphore = self.semaphores.get(self.base_url)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.concurrency)
+            self.semaphores[self.base_url] = semaphore
+        return semaphore
+
+    def request_headers(self, headers=None):
+        """
+        認証情報を含むリクエストヘッダを作成する
+        """
+        # APIサーバにもgzipで圧縮したレスポンスを要求する(httpxが展開する)
+        request_headers = {"Authorization": "Bearer " + self.token,
+                           "Accept": "application/json",
+                           "Accept-Encoding": "gzip"}
+        if headers:
+            request_headers.update(headers)
+        return request_headers
+
+    async def get(self, path, headers=None, **kwargs):
+        """
+        APIサーバへGETリクエストを送信する
+
+        Parameters:
+        - path: ベースURLからのパス(例: api/v1/pods)
+        - headers: 追加するリクエストヘッダ
+        - kwargs: httpx.AsyncClient.getに渡すその他の引数
+
+        Returns:
+        - httpx.Response: APIサーバのレスポンス
+        """
+        await self.reload()
+        async with self.semaphore():
+            return await self.client().get(
+                self.base_url + path,
+                headers=self.request_headers(headers),
+                **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def stream(self, path, headers=None, **kwargs):
+        """
+        APIサーバへGETリクエストを送信し、レスポンスを逐次読み出す(WATCH用)
+        長時間接続するため、LISTの同時実行数とコネクションプールには含めない
+        """
+        await self.reload()
+        async with self.watch_client().stream(
+                "GET",
+                self.base_url + path,
+                headers=self.request_headers(headers),
+                **kwargs) as res:
+            yield res
+
+    async def close(self):
+        """
+        すべての非同期HTTPクライアントを閉じる
+        """
+        for client in list(self.clients.values()) + \
+                list(self.watch_clients.values()):
+            await client.aclose()
+        self.clients = {}
+        self.watch_clients = {}
+
+
+# k8sクラスタへの接続(プロセス内で共有する)
+cluster = ClusterClient(
+    k8s_cluster_token_path,
+    k8s_cluster_address_path,
+    k8s_cluster_ca_path,
+    aggregator_pool_size,
+    aggregator_upstream_concurrency,
+    aggregator_insecure_skip_verify)
+
+
+class ResourceCache:
+    """
+    1つの(kind, namespace, セレクタ)のリソースをLIST+WATCHでメモリ上に保持するクラス
+
+    最初にLISTで全件を取得し、以降はそのresourceVersionからWATCH(ブックマーク付き)で
+    差分を反映する。WATCHが410 Goneとなった場合とresyncの間隔ごとにLISTし直す。
+    LIST+WATCHはイベントループ上のタスクとして実行する。
+
+    Attributes:
+    - path: ベースURLからのパス
+    - selectors: LIST, WATCHに付与するlabelSelector, fieldSelector
+    - items: (namespace, name)をキーとした、各リソースのjson(bytes)
+    - resource_version: 反映済みのresourceVersion
+    - synced_at: 最後にAPIサーバと同期した時刻
+    - ready: 最初のLISTが完了したかどうか
+    - used_at: 最後に応答に使われた時刻(time.monotonic)
+    """
+
+    def __init__(self, path, selectors=None):
+        self.path = path
+        self.selectors = selectors or {}
+        self.items = {}
+        self.head = {}
+        self.resource_version = None
+        self.synced_at = None
+        self.snapshots = {}
+        self.ready = False
+        self.task = None
+        self.used_at = time.monotonic()
+
+    def start(self):
+        """
+        LIST+WATCHのタスクを開始する
+        """
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        """
+        LIST+WATCHのタスクを止める
+        """
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        """
+        LISTとWATCHを繰り返してキャッシュを最新に保つ
+        """
+        print("cache started. " + self.path)
+        while True:
+            try:
+                await self.relist()
+                await self.watch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("cache error. " + self.path + " " + repr(e))
+                await asyncio.sleep(5)
+
+    async def relist(self):
+        """
+        LIST(limit/continueで分割)で全件を取得し、キャッシュを置き換える
+        """
+        items = {}
+        params = dict(self.selectors)
+        if aggregator_page_size > 0:
+            params["limit"] = aggregator_page_size
+        while True:
+            res = await cluster.get(
+                self.path, params=params, timeout=page_timeout())
+            if res.status_code != 200:
+                raise RuntimeError(
+                    "LIST failed. status code is " + str(res.status_code))
+            page = res.json()
+            for item in page.get("items") or []:
+                items[item_key(item)] = json.dumps(
+                    item, separators=(",", ":")).encode()
+            metadata = page.get("metadata") or {}
+            if not metadata.get("continue"):
+                break
+            params["continue"] = metadata["continue"]
+
+        self.head = {"kind": page.get("kind"),
+                     "apiVersion": page.get("apiVersion")}
+        self.items = items
+        self.resource_version = metadata.get("resourceVersion")
+        self.synced_at = time.time()
+        self.snapshots = {}
+        self.ready = True
+
+    async def watch(self):
+        """
+        resyncの間隔が経過するまでWATCHし、イベントをキャッシュに反映する
+        410 Goneの場合はLISTし直すために戻る
+        WATCHがすぐに終了する場合(アイドルな接続を切るプロキシなど)は、
+        間隔をあけて張り直し、APIサーバへ連続してリクエストしない
+        """
+        deadline = time.monotonic() + aggregator_cache_resync
+        backoff = aggregator_cache_watch_interval
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            remaining = int(deadline - started) + 1
+            params = dict(
+                self.selectors,
+                watch="true",
+                resourceVersion=self.resource_version,
+                allowWatchBookmarks="true",
+                timeoutSeconds=remaining)
+            async with cluster.stream(
+                    self.path, params=params,
+                    timeout=httpx.Timeout(remaining + 30, connect=3.0)) \
+                    as res:
+                if res.status_code == 410:
+                    return
+                if res.status_code != 200:
+                    raise RuntimeError(
+                        "WATCH failed. status code is " +
+                        str(res.status_code))
+                async for line in res.aiter_lines():
+                    if not line:
+                        continue
+                    event = json.loads(line)
+                    if event["type"] == "ERROR":
+                        # resourceVersionが古すぎる場合(410 Gone)はLISTし直す
+                        if event["object"].get("code") == 410:
+                            return
+                        raise RuntimeError(
+                            "WATCH error. " + str(event["object"]))
+                    self.apply(event)
+
+            # 最短の間隔より早く終了した場合は待ってから張り直す
+            if time.monotonic() - started < aggregator_cache_watch_interval:
+                await asyncio.sleep(
+                    min(backoff, max(deadline - time.monotonic(), 0)))
+                backoff = min(backoff * 2, aggregator_cache_watch_backoff_max)
+            else:
+                backoff = aggregator_cache_watch_interval
+
+    def apply(self, event):
+        """
+        WATCHのイベント(ADDED, MODIFIED, DELETED, BOOKMARK)をキャッシュに反映する
+        """
+        obj = event["object"]
+        if event["type"] in ("ADDED", "MODIFIED"):
+            self.items[item_key(obj)] = json.dumps(
+                obj, separators=(",", ":")).encode()
+            self.snapshots = {}
+        elif event["type"] == "DELETED":
+            self.items.pop(item_key(obj), None)
+            self.snapshots = {}
+        elif obj["metadata"]["resourceVersion"] != self.resource_version:
+            # BOOKMARKでもListのresourceVersion(X-Resource-Version)を進めるため作成し直す
+            # (ETagはresourceVersionを含まないため変わらない)
+            self.snapshots = {}
+        self.resource_version = obj["metadata"]["resourceVersion"]
+        self.synced_at = time.time()
+
+    def snapshot(self, projection=None, encoding=None):
+        """
+        キャッシュの内容からListのjsonを作成して返す
+        (変化が無い間は、射影と圧縮方式ごとに作成済みのものを返す)
+
+        Parameters:
+        - projection: 各itemに適用するProjection(Noneの場合は適用しない)
+        - encoding: 圧縮方式(Noneの場合は圧縮しない)
+
+        Returns:
+        - body: Listのjson(bytes)
+        - headers: 変更検知用のヘッダとキャッシュの経過時間(秒)、件数
+          (圧縮した場合はContent-Encodingを含む)
+        """
+        key = projection.key if projection else None
+        if key not in self.snapshots:
+            head = dict(self.head)
+            head["metadata"] = {"resourceVersion": self.resource_version}
+            # LISTと同じくnamespace, nameの順に並べる
+            items = [self.items[k] for k in sorted(self.items)]
+            if projection:
+                items = [
+                    json.dumps(projection.apply(json.loads(item)),
+                               separators=(",", ":")).encode()
+                    for item in items]
+            body = \
+                json.dumps(head, separators=(",", ":"))[:-1].encode() + \
+                b',"items":[' + b",".join(items) + b"]}"
+            self.snapshots[key] = (body, snapshot_headers(body), {})
+        body, headers, encoded = self.snapshots[key]
+        headers = dict(headers)
+        if encoding is not None:
+            if encoding not in encoded:
+                encoded[encoding] = encode_body(body, encoding)
+            body, content_encoding = encoded[encoding]
+            encoding_headers(headers, content_encoding)
+        headers["X-Cache-Age"] = str(int(time.time() - self.synced_at))
+        headers["X-Cache-Items"] = str(len(self.items))
+        return body, headers
+
+    def status(self):
+        """
+        キャッシュの状態(準備完了か、経過時間、件数、resourceVersion)を返す
+        """
+        return {
+            "path": self.path,
+            "selectors": self.selectors,
+            "ready": self.ready,
+            "age": None if self.synced_at is None
+            else int(time.time() - self.synced_at),
+            "items": len(self.items),
+            "resourceVersion": self.resource_version,
+            "idle": int(time.monotonic() - self.used_at)
+        }
+
+
+def item_key(item):
+    """
+    リソースのキャッシュ上のキー(namespace, name)を返す
+    """
+    metadata = item["metadata"]
+    return (metadata.get("namespace", ""), metadata["name"])
+
+
+# (path, セレクタ)をキーとしたResourceCache
+caches = {}
+
+
+def get_cache(path, selectors=None):
+    """
+    (path, セレクタ)のResourceCacheを返す。無い場合は作成してLIST+WATCHを開始する
+    """
+    selectors = selectors or {}
+    key = (path, tuple(sorted(selectors.items())))
+    evict_caches(key)
+    cache = caches.get(key)
+    if cache is None:
+        cache = ResourceCache(path, selectors)
+        caches[key] = cache
+        cache.start()
+    cache.used_at = time.monotonic()
+    return cache
+
+
+def evict_caches(keep):
+    """
+    AGGREGATOR_CACHE_IDLE秒以上使われていないキャッシュと、
+    AGGREGATOR_CACHE_MAXを超える分の最も長く使われていないキャッシュを削除する
+
+    Parameters:
+    - keep: 削除しないキャッシュのキー(これから使うもの)
+    """
+    now = time.monotonic()
+    # これから作成する分を含めたキャッシュの数
+    count = len(caches) + (keep not in caches)
+    # 最も長く使われていないものから順に削除する
+    for key, cache in sorted(caches.items(), key=lambda c: c[1].used_at):
+        if key == keep:
+            continue
+        if now - cache.used_at < aggregator_cache_idle and \
+                count <= aggregator_cache_max:
+            break
+        cache.stop()
+        del caches[key]
+        count -= 1
+        print("cache evicted. " + cache.path)
+
+
+def selector_params(label_selector=None, field_selector=None):
+    """
+    LISTに付与するlabelSelector, fieldSelectorのクエリパラメータを作成する
+    (指定されていないものは含めない)
+    """
+    selectors = {}
+    if label_selector:
+        selectors["labelSelector"] = label_selector
+    if field_selector:
+        selectors["fieldSelector"] = field_selector
+    return selectors
+
+
+def page_timeout():
+    """
+    LISTの1ページごとのタイムアウトを返す(接続は3秒)
+    """
+    return httpx.Timeout(aggregator_page_timeout, connect=3.0)
+
+
+def negotiate_encoding(request):
+    """
+    クライアントのAccept-Encodingから、レスポンスの圧縮方式を決める
+
+    Returns:
+    - encoding: zstd, gzipのいずれか。圧縮しない場合はNone
+    """
+    accepted = set()
+    for value in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = value.partition(";")
+        # q=0は受け付けないことを表す
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(name.strip().lower())
+    for encoding in aggregator_compression:
+        if encoding == "zstd" and zstandard is None:
+            continue
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return None
+
+
+def compressor(encoding):
+    """
+    圧縮方式に応じた逐次圧縮用のオブジェクト(compress, flushを持つ)を返す
+    """
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(
+            level=aggregator_zstd_level).compressobj()
+    # wbits=31でgzip形式にする
+    return zlib.compressobj(aggregator_gzip_level, zlib.DEFLATED, 31)
+
+
+def encode_body(body, encoding):
+    """
+    bodyを圧縮する。圧縮方式が無い場合と小さい場合は圧縮しない
+
+    Returns:
+    - body: 圧縮した(または元の)bytes
+    - encoding: 圧縮方式。圧縮しなかった場合はNone
+    """
+    if encoding is None or len(body) < aggregator_compress_min_size:
+        return body, None
+    c = compressor(encoding)
+    return c.compress(body) + c.flush(), encoding
+
+
+async def encode_stream(chunks, encoding):
+    """
+    非同期ジェネレータが返すbytesを逐次圧縮して返すジェネレータ
+    """
+    c = compressor(encoding)
+    async for chunk in chunks:
+        data = c.compress(chunk)
+        if data:
+            yield data
+    yield c.flush()
+
+
+def encoding_headers(headers, encoding):
+    """
+    圧縮方式に応じたレスポンスヘッダ(Content-Encoding, Vary)を追加する
+    """
+    headers["Vary"] = "Accept-Encoding"
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return headers
+
+
+async def cancel_on_disconnect(request, coro):
+    """
+    coroを実行し、その間にクライアントが切断した場合はcoroをキャンセルする
+
+    Parameters:
+    - request: クライアントからのリクエスト
+    - coro: 実行するコルーチン
+
+    Returns:
+    - coroの結果
+
+    Raises:
+    - HTTPException: クライアントが切断した場合(499)
+    """
+    task = asyncio.ensure_future(coro)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=0.5)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            task.cancel()
+            print("client disconnected. request is cancelled.")
+            raise HTTPException(
+                status_code=499, detail="Client Closed Request")
+
+
+class DiscoveryIndex:
+    """
+    APIサーバのディスカバリ(/api, /apis)から作成した、kindとAPIのURL情報の索引
+
+    索引はTTLごとにバックグラウンドで取得し直し、検索は辞書の参照のみで行う。
+    未知のkindの場合(CRDの追加直後など)は、一定の間隔をあけて索引を取得し直す。
+    kindが複数のAPIグループに存在する場合、coreを優先し、それ以外は
+    「Kind.group」(例: Event.events.k8s.io)で指定できる。
+
+    Attributes:
+    - index: kind(または「Kind.group」)をキーとした(api_version, resource_type, namespaced)
+    - loaded_at: 最後に索引を取得した時刻
+    """
+
+    def __init__(self, ttl, miss_interval):
+        self.ttl = ttl
+        self.miss_interval = miss_interval
+        self.index = {}
+        self.loaded_at = None
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    async def lookup(self, kind):
+        """
+        kindのAPIのURL情報を返す
+
+        Returns:
+        - api_version: APIバージョンのURL情報
+        - resource_type: リソースタイプのURL情報
+        - namespaced: namespaceに属するリソースかどうか
+
+        Raises:
+        - ValueError: APIサーバが提供していないkindの場合
+        """
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+        entry = self.index.get(kind)
+        if entry is None and (
+                self.loaded_at is None or
+                time.monotonic() - self.loaded_at > self.miss_interval):
+            await self.refresh(self.loaded_at)
+            entry = self.index.get(kind)
+        if entry is None:
+            raise ValueError("kind: " + str(kind) + " is not supported")
+        return entry
+
+    async def run(self):
+        """
+        TTLごとに索引を取得し直す
+        (接続情報のファイルが読めない場合なども、タスクを止めずに次の周期で取得し直す)
+        """
+        while True:
+            try:
+                await self.refresh(self.loaded_at)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("discovery error. " + repr(e))
+            await asyncio.sleep(self.ttl)
+
+    async def refresh(self, loaded_at):
+        """
+        /api, /apisから索引を作成し直す
+        (loaded_at以降に他で取得し直していた場合は何もしない)
+        失敗した場合は、前回の索引をそのまま使う
+        """
+        async with self.lock:
+            if self.loaded_at != loaded_at:
+                return
+            try:
+                self.index = await self.discover()
+                print("discovery index is loaded. kinds: " +
+                      str(len(self.index)))
+            except (httpx.HTTPError, RuntimeError, ValueError) as e:
+                print("discovery failed. " + repr(e))
+            self.loaded_at = time.monotonic()
+
+    async def discover(self):
+        """
+        coreとすべてのAPIグループ(優先バージョン)のリソース一覧を取得し、索引を作成する
+        """
+        versions = await self.get_json("api")
+        group_versions = [
+            "api/" + v for v in versions.get("versions") or []]
+        groups = await self.get_json("apis")
+        for group in groups.get("groups") or []:
+            preferred = group.get("preferredVersion") or \
+                (group.get("versions") or [{}])[0]
+            if preferred.get("groupVersion"):
+                group_versions.append("apis/" + preferred["groupVersion"])
+
+        # 各グループバージョンのリソース一覧は並行して取得する
+        resource_lists = await asyncio.gather(
+            *(self.get_json(gv) for gv in group_versions),
+            return_exceptions=True)
+
+        index = {}
+        for api_version, resources in zip(group_versions, resource_lists):
+            if isinstance(resources, Exception):
+                # 応答しないAPIServiceなどは読み飛ばす
+                print("discovery of " + api_version + " failed. " +
+                      repr(resources))
+                continue
+            group = api_version.split("/")[1] \
+                if api_version.startswith("apis/") else ""
+            for resource in resources.get("resources") or []:
+                # サブリソース(pods/logなど)とLISTできないリソースは対象外
+                if "/" in resource["name"] or \
+                        "list" not in (resource.get("verbs") or []):
+                    continue
+                entry = (api_version, resource["name"],
+                         resource.get("namespaced", True))
+                index.setdefault(resource["kind"], entry)
+                if group:
+                    index.setdefault(resource["kind"] + "." + group, entry)
+        return index
+
+    async def get_json(self, path):
+        """
+        ディスカバリのエンドポイントを取得してjsonを返す
+        """
+        res = await cluster.get(path, timeout=page_timeout())
+        if res.status_code != 200:
+            raise RuntimeError(
+                path + " failed. status code is " + str(res.status_code))
+        return res.json()
+
+    def kinds(self):
+        """
+        索引に含まれるkindの一覧を返す
+        """
+        return [
+            {"kind": kind, "apiVersion": api_version,
+             "resource": resource_type, "namespaced": namespaced}
+            for kind, (api_version, resource_type, namespaced)
+            in sorted(self.index.items())]
+
+
+# kindの索引(プロセス内で共有する)
+discovery = DiscoveryIndex(
+    aggregator_discovery_ttl, aggregator_discovery_miss_interval)
+
+
+async def get_api_version_and_resource_type(kind):
     """
     KubernetesのKindからAPIバージョンとリソースタイプのURL情報を取得
+    APIサーバが提供しているすべてのkind(CRDを含む)に対応する
 
     Parameters:
-    - kind: Kubernetesのリソースの種類
+    - kind: Kubernetesのリソースの種類(または「Kind.group」)
 
     Returns:
     - api_version: APIバージョンのURL情報
     - resource_type: リソースタイプのURL情報
+    - namespaced: namespaceに属するリソースかどうか
 
     Raises:
     - ValueError: サポートされていないリソースの場合
     """
-    # aggregatorが対応しているkindの種類を定義
-    # 対応させたいリソースタイプを増やす場合は以下に同様にリソースを追記すれば良い
-    mapping = {
-        "Pod": ("api/v1", "pods"),
-        "Service": ("api/v1", "services"),
-        "Deployment": ("apis/apps/v1", "deployments"),
-        "ReplicaSet": ("apis/apps/v1", "replicasets"),
-        "StatefulSet": ("apis/apps/v1", "statefulsets"),
-        "Spreadsheet": ("apis/sbp.vmware.jp/v1alpha1", "spreadsheet"),
-        "StorageClass": ("apis/storage.k8s.io/v1", "storageclasses")
-    }
-    # mapping情報をもとにkindからapi_version, resource_typeを検索
-    api_version, resource_type = mapping.get(kind, (None, None))
+    return await discovery.lookup(kind)
 
-    # api_versionとresource_typeが存在していればそれを返す、存在していなければエラーを返す
-    if api_version and resource_type:
-        return api_version, resource_type
 
-    raise ValueError("kind: " + kind + " is not supported")
+async def resource_path(kind, ns=None):
+    """
+    kindとnamespaceから、APIのエンドポイントのベースURLからのパスを生成する
+
+    Parameters:
+    - kind: Kubernetesのリソースの種類
+    - ns: 対象となるnamespace。指定しない場合は全てのnamespace。
 
+    Returns:
+    - path: ベースURLからのパス(例: api/v1/namespaces/default/pods)
+
+    Raises:
+    - ValueError: サポートされていないリソースの場合
+    """
+    api_version, resource_type, namespaced = \
+        await get_api_version_and_resource_type(kind)
 
-@app.get("/api/v1/resource", response_class=JSONResponse)
-def get_kubernetes_resource(ns: str = None, kind: str = None):
+    # namespaceの指定がない場合とnamespaceに属さないリソースの場合、すべてのnsを対象とする
+    if ns is None or not namespaced:
+        return api_version + "/" + resource_type
+    return api_version + "/namespaces/" + ns + "/" + resource_type
+
+
+# フィールドのパスの各要素(.key, ['key'], ["key"], [*], *)を取り出す正規表現
+FIELD_PATH_SEGMENT = re.compile(
+    r"""\.?(?:\[\s*'([^']*)'\s*\]|\[\s*"([^"]*)"\s*\]|\[(\*)\]|"""
+    r"""([^.\[\]]+))""")
+
+
+def parse_field_path(path):
+    """
+    JSONPath形式のフィールドのパスを要素のtupleに変換する
+    例: "metadata.annotations['a.b/c']" -> ("metadata", "annotations", "a.b/c")
+    "*"はすべてのkey(リストの場合はすべての要素)を表す
+
+    Raises:
+    - ValueError: パスとして解釈できない場合
+    """
+    path = path.strip()
+    # kubectlのJSONPath形式({.metadata.name}, $.metadata.name)も受け付ける
+    if path.startswith("{") and path.endswith("}"):
+        path = path[1:-1]
+    if path.startswith("$"):
+        path = path[1:]
+    segments = []
+    pos = 0
+    while pos < len(path):
+        match = FIELD_PATH_SEGMENT.match(path, pos)
+        if not match or match.end() == pos:
+            raise ValueError("invalid field path: " + path)
+        segments.append(next(g for g in match.groups() if g is not None))
+        pos = match.end()
+    if not segments:
+        raise ValueError("invalid field path: " + path)
+    return tuple(segments)
+
+
+def field_tree(paths):
+    """
+    パスのリストを、要素をキーとした木(辞書)に変換する
+    末端(その値すべてを対象とする)はNoneで表す
+    """
+    tree = {}
+    for path in paths:
+        node = tree
+        for segment in path[:-1]:
+            child = node.get(segment, {})
+            if child is None:
+                break
+            node = node.setdefault(segment, child)
+        else:
+            node[path[-1]] = None
+    return tree
+
+
+def merge_tree(a, b):
+    """
+    2つの木を合わせた木を返す(どちらかが末端の場合は末端)
+    """
+    if a is None or b is None:
+        return None
+    tree = dict(a)
+    for key, child in b.items():
+        tree[key] = merge_tree(tree[key], child) if key in tree else child
+    return tree
+
+
+def child_tree(tree, key):
+    """
+    木のkeyに該当する子(keyと"*"を合わせたもの)を返す。該当しない場合はFalse
+    """
+    children = [tree[k] for k in (key, "*") if k in tree]
+    if not children:
+        return False
+    if len(children) == 1:
+        return children[0]
+    return merge_tree(*children)
+
+
+# pick_fieldsで該当するフィールドが無いことを表す値
+MISSING = object()
+
+
+def pick_fields(value, tree):
+    """
+    valueのうち、木に含まれるフィールドのみを残した値を返す
+    """
+    if tree is None:
+        return value
+    if isinstance(value, dict):
+        picked = {}
+        for key, child in value.items():
+            subtree = child_tree(tree, key)
+            if subtree is False:
+                continue
+            child = pick_fields(child, subtree)
+            if child is not MISSING:
+                picked[key] = child
+        return picked if picked else MISSING
+    if isinstance(value, list) and "*" in tree:
+        picked = [pick_fields(child, tree["*"]) for child in value]
+        return [child for child in picked if child is not MISSING]
+    return MISSING
+
+
+def prune_fields(value, tree):
+    """
+    valueから、木に含まれるフィールドを削除する(valueを直接変更する)
+    """
+    if isinstance(value, dict):
+        for key in list(value):
+            subtree = child_tree(tree, key)
+            if subtree is None:
+                del value[key]
+            elif subtree is not False:
+                prune_fields(value[key], subtree)
+    elif isinstance(value, list) and "*" in tree:
+        if tree["*"] is None:
+            value.clear()
+            return
+        for child in value:
+            prune_fields(child, tree["*"])
+
+
+def leaf_keys(tree):
+    """
+    木の末端(削除するフィールド)のkeyの集合を返す
+    """
+    keys = set()
+    for key, child in tree.items():
+        if child is None:
+            keys.add(key)
+        else:
+            keys |= leaf_keys(child)
+    return keys
+
+
+class Projection:
+    """
+    各itemに適用するフィールドの射影(残すフィールドと除外するフィールド)
+
+    includeを指定した場合はそのフィールドのみを残す(metadata.name, namespaceは常に残す)。
+    その後、excludeのフィールドを削除する。
+
+    Attributes:
+    - include: 残すフィールドの木(Noneの場合はすべて残す)
+    - exclude: 除外するフィールドの木
+    - key: 射影を識別するためのキー(キャッシュ用)
+    """
+
+    def __init__(self, include=None, exclude=None):
+        include = sorted(set(include or []))
+        exclude = sorted(set(exclude or []))
+        self.key = (tuple(include), tuple(exclude))
+        if include:
+            self.include = field_tree(
+                [parse_field_path(p) for p in include] +
+                [("metadata", "name"), ("metadata", "namespace")])
+        else:
+            self.include = None
+        self.exclude = field_tree([parse_field_path(p) for p in exclude])
+
+    def __bool__(self):
+        return self.include is not None or bool(self.exclude)
+
+    def affects(self, body):
+        """
+        射影によってbody(jsonのbytes)が変わる可能性があるかを返す
+        excludeのみの場合、除外するフィールドのkeyがbodyに含まれていなければ変わらないため、
+        パースと再エンコードを省略できる
+
+        Parameters:
+        - body: Listのjson(bytes)
+        """
+        if self.include is not None:
+            return True
+        keys = leaf_keys(self.exclude)
+        if "*" in keys:
+            return True
+        return any(json.dumps(key).encode() in body for key in keys)
+
+    def apply(self, item):
+        """
+        itemに射影を適用する(itemを直接変更する場合がある)
+        """
+        if self.include is not None:
+            item = pick_fields(item, self.include)
+            if item is MISSING:
+                item = {}
+        if self.exclude:
+            prune_fields(item, self.exclude)
+        return item
+
+
+def projection_for(kind, include=None, exclude=None, defaults=True):
+    """
+    kindのデフォルトの除外フィールドと指定されたフィールドからProjectionを作成する
+
+    Parameters:
+    - kind: Kubernetesのリソースの種類
+    - include: 残すフィールドのパスのリスト
+    - exclude: 除外するフィールドのパスのリスト
+    - defaults: kindごとのデフォルトの除外フィールドを適用するかどうか
+
+    Raises:
+    - ValueError: パスとして解釈できない場合
+    """
+    exclude = list(exclude or [])
+    if defaults:
+        exclude += aggregator_projection_defaults.get("*", [])
+        exclude += aggregator_projection_defaults.get(kind, [])
+    return Projection(include, exclude)
+
+
+def snapshot_headers(body):
+    """
+    リソースのjson情報から、変更検知用のレスポンスヘッダを作成する
+
+    Parameters:
+    - body: APIサーバのレスポンスのbytes
+
+    Returns:
+    - headers: X-Resource-Version(Listのmetadata.resourceVersion)と
+      X-Content-Hash(Listのmetadata.resourceVersionを除いた内容のsha256)、
+      ETag(X-Content-Hashの弱いETag。圧縮方式によらず同じ値とする)
+    """
+    headers = {}
+    # Listのmetadataはitemsより前にあるため、itemsより前の部分のみを検索する
+    items_pos = body.find(b'"items"')
+    match = LIST_RESOURCE_VERSION.search(
+        body, 0, items_pos if items_pos >= 0 else len(body))
+    if match:
+        headers["X-Resource-Version"] = match.group(1).decode()
+        # Listのresourceversionはリソースに変化がなくても変わるため、ハッシュの対象外とする
+        digest = hashlib.sha256(body[:match.start(1)])
+        digest.update(body[match.end(1):])
+    else:
+        digest = hashlib.sha256(body)
+    headers["X-Content-Hash"] = digest.hexdigest()
+    headers["ETag"] = 'W/"' + headers["X-Content-Hash"] + '"'
+    return headers
+
+
+async def spool_list(chunks):
+    """
+    Listのjsonの断片を一時ファイル(小さい場合はメモリ)に書き出しながら、
+    snapshot_headersと同じ変更検知用のヘッダを計算する
+    (全ページを1つのbytesに結合せずにETagを求めるため)
+
+    Parameters:
+    - chunks: stream_listが返すListのjsonの断片
+
+    Returns:
+    - spool: 書き出したListのjson(先頭に戻した一時ファイル)
+    - headers: X-Resource-Version, X-Content-Hash, ETag
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=aggregator_spool_max_size)
+    digest = hashlib.sha256()
+    headers = {}
+    first = True
+    try:
+        async for chunk in chunks:
+            spool.write(chunk)
+            if first:
+                # 1つ目の断片はitemsより前の部分。Listのresourceversionはハッシュの対象外とする
+                first = False
+                match = LIST_RESOURCE_VERSION.search(chunk)
+                if match:
+                    headers["X-Resource-Version"] = match.group(1).decode()
+                    digest.update(chunk[:match.start(1)])
+                    digest.update(chunk[match.end(1):])
+                    continue
+            digest.update(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    headers["X-Content-Hash"] = digest.hexdigest()
+    headers["ETag"] = 'W/"' + headers["X-Content-Hash"] + '"'
+    spool.seek(0)
+    return spool, headers
+
+
+async def read_spool(spool, size=64 * 1024):
+    """
+    一時ファイルの内容を順に返し、最後に閉じるジェネレータ
+    """
+    try:
+        while True:
+            chunk = spool.read(size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        spool.close()
+
+
+def etag_matches(request, etag):
+    """
+    リクエストのIf-None-MatchがETagと一致するかを返す(弱い比較)
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def not_modified_response(headers):
+    """
+    304 Not Modifiedのレスポンスを作成する(bodyは送らない)
+    """
+    headers = {k: v for k, v in headers.items()
+               if k in ("ETag", "X-Resource-Version", "X-Content-Hash",
+                        "X-Cache", "X-Cache-Age", "X-Cache-Items")}
+    headers["Vary"] = "Accept-Encoding"
+    return Response(status_code=304, headers=headers)
+
+
+async def stream_list(path, page, projection=None, selectors=None):
+    """
+    LISTの1ページ目以降をcontinueで取得し、itemsを結合したListのjsonを順に返すジェネレータ
+    クライアントが切断した場合は、実行中のリクエストごとキャンセルされる
+
+    Parameters:
+    - path: ベースURLからのパス
+    - page: 取得済みの1ページ目(パース済みのjson)
+    - projection: 各itemに適用するProjection(Noneの場合は適用しない)
+    - selectors: 1ページ目と同じlabelSelector, fieldSelector
+
+    Returns:
+    - bytes: Listのjsonの断片
+    """
+    # items以外(kind, apiVersion, metadata)を先に返す。metadataのcontinue等は除く
+    head = {k: v for k, v in page.items() if k != "items"}
+    metadata = dict(head.get("metadata") or {})
+    metadata.pop("continue", None)
+    metadata.pop("remainingItemCount", None)
+    head["metadata"] = metadata
+    yield json.dumps(head, separators=(",", ":"))[:-1].encode() + \
+        b',"items":['
+
+    separator = b""
+    while True:
+        # 1ページ分のitemsを返す
+        items = page.get("items") or []
+        if projection:
+            items = [projection.apply(item) for item in items]
+        if items:
+            yield separator + b",".join(
+                json.dumps(item, separators=(",", ":")).encode()
+                for item in items)
+            separator = b","
+
+        # 次のページを取得
+        token = (page.get("metadata") or {}).get("continue")
+        if not token:
+            break
+        res = await cluster.get(
+            path,
+            params=dict(selectors or {}, limit=aggregator_page_size,
+                        **{"continue": token}),
+            timeout=page_timeout())
+        if res.status_code != 200:
+            # レスポンスヘッダは送信済みのため、途中で打ち切る
+            print("LIST continue failed. status code is " +
+                  str(res.status_code))
+            raise RuntimeError("LIST continue failed: " + res.text)
+        page = res.json()
+
+    yield b"]}"
+
+
+@app.get("/api/v1/resource", response_class=Response)
+async def get_kubernetes_resource(
+        request: Request, ns: str = None, kind: str = None,
+        include: List[str] = Query(None), exclude: List[str] = Query(None),
+        defaults: bool = True, labelSelector: str = None,
+        fieldSelector: str = None, etag: bool = False):
     """
     Kubernetesクラスタから指定されたリソースのjson情報を取得し、fastapiをコールしたクライアントに情報を返す
+    射影が無い場合は、APIサーバのレスポンスのbytesを再エンコードせず、そのままクライアントに返す
 
     Parameters:
+    - request: クライアントからのリクエスト(切断の検知に用いる)
     - ns: 対象となるnamespace。指定しない場合は全てのnamespace。
     - kind: 取得するリソースの種類。
+    - include: 残すフィールドのパス(複数指定可)。指定しない場合はすべて残す。
+    - exclude: 除外するフィールドのパス(複数指定可)。
+    - defaults: kindごとのデフォルトの除外フィールドを適用するかどうか。
+    - labelSelector: LISTに付与するlabelSelector(APIサーバで絞り込む)。
+    - fieldSelector: LISTに付与するfieldSelector(APIサーバで絞り込む)。
+    - etag: trueの場合、LISTが複数ページでも結合してからETagを付与する。
+      If-None-MatchがETagと一致する場合は304を返す。
 
     Returns:
-    - res_body: リソースのjson情報
+    - Response: リソースのjson情報(APIサーバのレスポンスのbytesとステータスコード)
     """
     # aggregatorの処理開始時刻をログに記録
     now = datetime.datetime.now()
     print("get_kubernetes_resource START! " +
           now.strftime('%Y年%m月%d日%H:%M:%S'))
 
-    # configmapから生成されたファイルより、k8sクラスタのトークンを取得
-    path = '/tmp/k8sClusterToken'
-    with open(path) as f:
-        token = f.read().strip()
-
-    # configmapから生成されたファイルより、k8sクラスタのIPアドレスを取得
-    path = '/tmp/k8sClusterIPaddress'
-    with open(path) as f:
-        k8sClusterIPaddress = f.read().strip()
-
-    # 取得したIPアドレスを元にベースURLを生成
-    base_url = "https://" + k8sClusterIPaddress + "/"
-
     # APIのエンドポイントURLを生成
     try:
-        api_version, resource_type = get_api_version_and_resource_type(kind)
+        path = await resource_path(kind, ns)
     except ValueError as e:
         print(e)
         raise HTTPException(status_code=500, detail="internal error")
 
-    # namespaceの指定がない場合、すべてのnsを対象とする
-    if ns is None:
-        url = base_url + api_version + "/" + resource_type
-    else:
-        url = base_url + api_version + "/namespaces/" + ns + \
-            "/" + resource_type
+    # 各itemに適用する射影を作成
+    try:
+        projection = projection_for(kind, include, exclude, defaults)
+    except ValueError as e:
+        print(e)
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # 絞り込みはAPIサーバのLIST(WATCH)で行う
+    selectors = selector_params(labelSelector, fieldSelector)
+
+    # クライアントが受け付ける場合、レスポンスを圧縮する
+    encoding = negotiate_encoding(request)
+
+    # キャッシュが有効な場合、準備ができていればキャッシュから応答する
+    # (準備中の場合はAPIサーバへ直接LISTする)
+    if aggregator_cache:
+        cache = get_cache(path, selectors)
+        if cache.ready:
+            # 前回から変化が無い場合は、圧縮する前に304を返す
+            _, headers = cache.snapshot(projection or None)
+            headers["X-Cache"] = "hit"
+            if etag_matches(request, headers["ETag"]):
+                return not_modified_response(headers)
+            body, headers = cache.snapshot(projection or None, encoding)
+            headers["X-Cache"] = "hit"
+            return Response(
+                content=body, headers=headers, media_type="application/json")
+        print("cache is warming up. " + path)
 
-    # リクエストヘッダを定義してAPIエンドポイントへリクエスト送信
-    headers = {"Authorization": "Bearer " + token,
-               "Accept": "application/json"}
+    # 共有の非同期クライアント(keep-alive接続)でAPIエンドポイントへリクエスト送信
+    # (limitを指定してLISTを分割して取得する。クライアントが切断した場合はキャンセル)
+    params = dict(selectors)
+    if aggregator_page_size > 0:
+        params["limit"] = aggregator_page_size
     try:
-        res = requests.get(url=url, headers=headers, verify=False, timeout=3.0)
-    except Timeout:
+        res = await cancel_on_disconnect(request, cluster.get(
+            path, params=params, timeout=page_timeout()))
+    except httpx.TimeoutException:
         raise HTTPException(status_code=408, detail="Timeout")
 
-    # レスポンスからリソースのjsonデータを取得
-    res_body = res.text
+    # レスポンスからリソースのjsonデータをbytesのまま取得
+    res_body = res.content
+
+    # 射影でbodyが変わる場合と続きのページがある場合のみ、jsonをパースする
+    # (除外するフィールドが含まれていなければ、APIサーバのbytesをそのまま返す)
+    page = None
+    if res.status_code == 200 and (
+            (projection and projection.affects(res_body)) or
+            b'"continue"' in res_body[:res_body.find(b'"items"')]):
+        page = json.loads(res_body)
+
+    # 続きのページがある場合、itemsを結合(射影を適用)しながらchunkedで返す
+    # (内容のハッシュは全ページを取得するまで分からないため、resourceVersionのみを付与する)
+    more = page is not None and (page.get("metadata") or {}).get("continue")
+    if more and (etag or request.headers.get("if-none-match")):
+        # ETagが必要な場合(etag=true, If-None-Match)は、全ページを一時ファイルに
+        # 書き出しながらハッシュを計算し、変化が無ければ304、あればファイルから返す
+        try:
+            spool, headers = await cancel_on_disconnect(
+                request, spool_list(stream_list(
+                    path, page, projection or None, selectors)))
+        except httpx.TimeoutException:
+            raise HTTPException(status_code=408, detail="Timeout")
+        except RuntimeError as e:
+            print(e)
+            raise HTTPException(status_code=502, detail="LIST failed")
+        print("get_kubernetes_resource SPOOLED! " +
+              datetime.datetime.now().strftime('%Y年%m月%d日%H:%M:%S'))
+        if etag_matches(request, headers["ETag"]):
+            spool.close()
+            return not_modified_response(headers)
+        chunks = read_spool(spool)
+        if encoding is not None:
+            chunks = encode_stream(chunks, encoding)
+        return StreamingResponse(
+            chunks,
+            headers=encoding_headers(headers, encoding),
+            media_type="application/json")
+    if more:
+        print("get_kubernetes_resource STREAMING! " +
+              datetime.datetime.now().strftime('%Y年%m月%d日%H:%M:%S'))
+        headers = {}
+        resource_version = page["metadata"].get("resourceVersion")
+        if resource_version:
+            headers["X-Resource-Version"] = resource_version
+        chunks = stream_list(path, page, projection or None, selectors)
+        if encoding is not None:
+            chunks = encode_stream(chunks, encoding)
+        return StreamingResponse(
+            chunks,
+            headers=encoding_headers(headers, encoding),
+            media_type="application/json")
+
+    # 1ページのみの場合、itemsに射影を適用して再エンコードする
+    if page is not None and page.get("items"):
+        page["items"] = [projection.apply(item) for item in page["items"]]
+        res_body = json.dumps(page, separators=(",", ":")).encode()
 
     # aggregatorの処理終了時刻をログに記録
     now = datetime.datetime.now()
     print("get_kubernetes_resource DONE! " + now.strftime('%Y年%m月%d日%H:%M:%S'))
 
     # リソースのjson情報をreturn
-    return res_body
+    # 変更検知用にresourceVersionと内容のハッシュ(ETag)をヘッダに付与する
+    # 前回から変化が無い場合(If-None-Matchと一致)は、bodyを送らずに304を返す
+    headers = snapshot_headers(res_body)
+    if res.status_code == 200 and etag_matches(request, headers["ETag"]):
+        return not_modified_response(headers)
+    res_body, content_encoding = encode_body(res_body, encoding)
+    return Response(
+        content=res_body,
+        status_code=res.status_code,
+        headers=encoding_headers(headers, content_encoding),
+        media_type="application/json")
+
+
+class BatchTarget(BaseModel):
+    """
+    バッチ取得の対象(kindとnamespace、射影、セレクタ)
+    """
+    kind: str
+    ns: Optional[str] = None
+    include: Optional[List[str]] = None
+    exclude: Optional[List[str]] = None
+    defaults: bool = True
+    labelSelector: Optional[str] = None
+    fieldSelector: Optional[str] = None
+
+
+class BatchRequest(BaseModel):
+    """
+    バッチ取得のリクエスト
+    """
+    targets: List[BatchTarget]
+
+
+async def fetch_list(path, projection=None, selectors=None):
+    """
+    pathのリソースを全ページ取得し、1つのListのjsonとして返す
+    キャッシュが有効で準備ができていればキャッシュから返す
+
+    Parameters:
+    - path: ベースURLからのパス
+    - projection: 各itemに適用するProjection(Noneの場合は適用しない)
+    - selectors: LISTに付与するlabelSelector, fieldSelector
+
+    Returns:
+    - status_code: APIサーバのステータスコード
+    - body: Listのjson(bytes)。失敗した場合はAPIサーバのレスポンス
+    """
+    if aggregator_cache:
+        cache = get_cache(path, selectors)
+        if cache.ready:
+            body, _ = cache.snapshot(projection)
+            return 200, body
+
+    params = dict(selectors or {})
+    if aggregator_page_size > 0:
+        params["limit"] = aggregator_page_size
+    res = await cluster.get(path, params=params, timeout=page_timeout())
+    if res.status_code != 200:
+        return res.status_code, res.content
+
+    if (projection is None or not projection.affects(res.content)) and \
+            b'"continue"' not in res.content[:res.content.find(b'"items"')]:
+        return 200, res.content
+
+    # 続きのページがある場合、itemsを結合(射影を適用)する
+    page = res.json()
+    return 200, b"".join(
+        [chunk async for chunk
+         in stream_list(path, page, projection, selectors)])
+
+
+async def fetch_target(target):
+    """
+    バッチ取得の対象1つを取得し、NDJSONの1行を作成する
+
+    Parameters:
+    - target: BatchTarget
+
+    Returns:
+    - bytes: {"kind", "ns", "status", "body"(Listのjson) または "error"}の1行
+      (200以外の場合は、APIサーバのレスポンスを"error"に文字列として入れる)
+    """
+    line = {"kind": target.kind, "ns": target.ns}
+    try:
+        projection = projection_for(
+            target.kind, target.include, target.exclude, target.defaults)
+        status_code, body = await fetch_list(
+            await resource_path(target.kind, target.ns), projection or None,
+            selector_params(target.labelSelector, target.fieldSelector))
+    except ValueError as e:
+        print(e)
+        line.update(status=500, error=str(e))
+    except httpx.TimeoutException:
+        line.update(status=408, error="Timeout")
+    except (httpx.HTTPError, RuntimeError) as e:
+        print("batch fetch failed. " + repr(e))
+        line.update(status=502, error=repr(e))
+    else:
+        line["status"] = status_code
+        if status_code != 200:
+            # APIサーバのエラーはjsonとは限らないため、文字列として返す
+            line["error"] = body.decode("utf-8", errors="replace").strip()
+            return json.dumps(line, separators=(",", ":")).encode() + b"\n"
+        # 1行に収めるため、改行を含む場合のみ再エンコードする
+        body = body.strip()
+        if b"\n" in body:
+            try:
+                body = json.dumps(
+                    json.loads(body), separators=(",", ":")).encode()
+            except ValueError as e:
+                line.update(status=502, error=repr(e))
+                return json.dumps(
+                    line, separators=(",", ":")).encode() + b"\n"
+        return json.dumps(line, separators=(",", ":"))[:-1].encode() + \
+            b',"body":' + body + b"}\n"
+    return json.dumps(line, separators=(",", ":")).encode() + b"\n"
+
+
+async def stream_batch(targets):
+    """
+    すべての対象を並行して取得し、取得できた順にNDJSONの行を返すジェネレータ
+    APIサーバへの同時実行数はClusterClientのセマフォで制限される
+    クライアントが切断した場合は、残りの取得をキャンセルする
+
+    Parameters:
+    - targets: BatchTargetのリスト
+
+    Returns:
+    - bytes: NDJSONの1行
+    """
+    tasks = [asyncio.ensure_future(fetch_target(t)) for t in targets]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+        print("get_kubernetes_resources DONE! " +
+              datetime.datetime.now().strftime('%Y年%m月%d日%H:%M:%S'))
+
+
+@app.post("/api/v1/resources", response_class=StreamingResponse)
+async def get_kubernetes_resources(request: Request, batch: BatchRequest):
+    """
+    複数の(kind, namespace)のリソースを並行して取得し、NDJSONで返す
+    1行が1つの対象に対応し、取得できた順に返す(順序はtargetsと一致しない)
+    現在のcontroller(Spreadsheetのspecは1つのkindのみ)とformatterはこのAPIを使わず、
+    GET /api/v1/resourceを使う。複数kindのレポートに対応する際の取得用のAPI
+
+    Parameters:
+    - request: クライアントからのリクエスト(圧縮方式の決定に用いる)
+    - batch: 取得する対象({"targets": [{"kind": "Pod", "ns": "default"}, ...]})
+
+    Returns:
+    - StreamingResponse: 対象ごとの
+      {"kind", "ns", "status", "body"(Listのjson) または "error"}の行
+    """
+    print("get_kubernetes_resources START! " +
+          datetime.datetime.now().strftime('%Y年%m月%d日%H:%M:%S'))
+    encoding = negotiate_encoding(request)
+    chunks = stream_batch(batch.targets)
+    if encoding is not None:
+        chunks = encode_stream(chunks, encoding)
+    return StreamingResponse(
+        chunks,
+        headers=encoding_headers({}, encoding),
+        media_type="application/x-ndjson")
+
+
+@app.get("/api/v1/cache", response_class=JSONResponse)
+def get_cache_status():
+    """
+    LIST+WATCHによるキャッシュごとの状態(準備完了か、経過時間、件数)を返す
+    """
+    return [cache.status() for cache in caches.values()]
+
+
+@app.get("/api/v1/kinds", response_class=JSONResponse)
+async def get_kinds():
+    """
+    ディスカバリで取得した、レポートの対象にできるkindの一覧を返す
+    """
+    if discovery.loaded_at is None:
+        await discovery.refresh(None)
+    return discovery.kinds()
+
+
+@app.on_event("startup")
+def warn_insecure_skip_verify():
+    """
+    アプリケーション起動時、証明書の検証を省略する設定であれば警告を出力する
+    """
+    if aggregator_insecure_skip_verify:
+        print("WARNING: AGGREGATOR_INSECURE_SKIP_VERIFY is enabled. "
+              "TLS verification is skipped when the CA file is not found.")
+
+
+@app.on_event("shutdown")
+async def close_cluster():
+    """
+    アプリケーション終了時にキャッシュのタスクを止め、HTTPクライアントを閉じる
+    """
+    for cache in caches.values():
+        cache.stop()
+    if discovery.task is not None:
+        discovery.task.cancel()
+    await cluster.close()
+
 
 if __name__ == "__main__":
     # アプリケーションの起動設定
@@ -6,21 +6,266 @@ import time
 import datetime
 import requests
 import re
+import gzip
+import zlib
+import heapq
+import itertools
+import concurrent.futures
+import http.server
+import copy
+import hashlib
+import urllib3
 from requests.exceptions import Timeout
+try:
+    # zstdで圧縮されたaggregatorのレスポンスのハッシュ計算用。無い場合はgzip, deflateのみ展開する
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # 標準出力、標準エラー出力、標準入力のバッファリングを調整
 sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', buffering=1)
 sys.stderr = os.fdopen(sys.stderr.fileno(), 'w', buffering=1)
 sys.stdin = os.fdopen(sys.stdin.fileno(), 'r', buffering=1)
 
+# aggregatorとformatterの間の圧縮の設定
+# CONTROLLER_ACCEPT_ENCODING: aggregatorに要求する圧縮方式
+#   (圧縮されたbodyは展開せずにそのままformatterへ転送するため、formatterが展開できる方式を指定する)
+# CONTROLLER_GZIP_LEVEL: aggregatorのレスポンスが圧縮されていない場合に、
+#   formatterへ送る前にgzipで圧縮する際の圧縮レベル(0の場合は圧縮しない)
+# CONTROLLER_COMPRESS_MIN_SIZE: これより小さいbodyは圧縮しない(byte)
+controller_accept_encoding = os.environ.get(
+    'CONTROLLER_ACCEPT_ENCODING', 'zstd, gzip')
+controller_gzip_level = int(os.environ.get('CONTROLLER_GZIP_LEVEL', '5'))
+controller_compress_min_size = int(
+    os.environ.get('CONTROLLER_COMPRESS_MIN_SIZE', '1024'))
+# CONTROLLER_RELAY: trueの場合、aggregatorのレスポンスをメモリに読み込まずに
+#   そのままformatterへ転送(chunked)する。falseの場合は全て読み込んでから送る
+# CONTROLLER_RELAY_CHUNK_SIZE: 転送する際に1回で読み込むサイズ(byte)
+controller_relay = os.environ.get(
+    'CONTROLLER_RELAY', 'true').lower() == 'true'
+controller_relay_chunk_size = int(
+    os.environ.get('CONTROLLER_RELAY_CHUNK_SIZE', '65536'))
 
-class StoppableThread(threading.Thread):
+# スケジューラの設定
+# CONTROLLER_WORKERS: 同時に実行するreconcileの数(ワーカースレッド数)
+# CONTROLLER_RETRY_INTERVAL: reconcileが例外で失敗した場合に再実行するまでの秒数
+# CONTROLLER_METRICS_PORT: メトリクス(/metrics)を公開するポート(0の場合は公開しない)
+controller_workers = int(os.environ.get('CONTROLLER_WORKERS', '4'))
+controller_retry_interval = float(
+    os.environ.get('CONTROLLER_RETRY_INTERVAL', '60'))
+controller_metrics_port = int(
+    os.environ.get('CONTROLLER_METRICS_PORT', '8080'))
+
+# formatterのジョブの完了待ちの設定
+# CONTROLLER_JOB_WAIT: 1回の問い合わせでジョブの完了を待つ最大秒数(long-poll)
+#   (待っている間以外はワーカーを空け、他のSpreadsheetのaggregatorへの問い合わせを進める)
+# CONTROLLER_JOB_TIMEOUT: ジョブの完了を待つ最大秒数。超えた場合は失敗とする
+controller_job_wait = float(os.environ.get('CONTROLLER_JOB_WAIT', '5'))
+controller_job_timeout = float(
+    os.environ.get('CONTROLLER_JOB_TIMEOUT', '900'))
+
+# statusの書き込みの設定
+# CONTROLLER_STATUS_INTERVAL: 1つのCRのstatusを書き込む最小の間隔(秒)
+#   (間隔内の途中経過は書き込まずにまとめ、サイクルの最後の書き込みは必ず行う)
+controller_status_interval = float(
+    os.environ.get('CONTROLLER_STATUS_INTERVAL', '5'))
+
+# Spreadsheetの監視(watch)の設定
+# CONTROLLER_WATCH_TIMEOUT: 1回のwatchの最大秒数(終了後は最後のresourceVersionから再開する)
+# CONTROLLER_WATCH_RETRY_INTERVAL: watchが切断された場合に再接続するまでの秒数
+controller_watch_timeout = int(
+    os.environ.get('CONTROLLER_WATCH_TIMEOUT', '300'))
+controller_watch_retry_interval = float(
+    os.environ.get('CONTROLLER_WATCH_RETRY_INTERVAL', '5'))
+
+
+def gzip_stream(chunks):
+    """
+    bytesのchunkを順にgzipで圧縮して返すジェネレータ。
+
+    :param chunks: bytesのイテレータ
+    :return: 圧縮したbytesのジェネレータ
+    """
+    compressor = zlib.compressobj(controller_gzip_level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# Listのmetadata.resourceVersionを取得するための正規表現(aggregatorと同じ)
+LIST_RESOURCE_VERSION = re.compile(rb'"resourceVersion"\s*:\s*"([^"]*)"')
+
+
+class ContentHasher:
+    """
+    formatterへ転送するbodyから、aggregatorのX-Content-Hashと同じハッシュ
+    (Listのmetadata.resourceVersionを除いた内容のsha256)を逐次計算する。
+    aggregatorが複数ページのLISTをETag無しでストリーミングした場合に、
+    次回の再検証(If-None-Match)に用いるETagを得るために使う
+
+    :param content_encoding: bodyのContent-Encoding
+    :raises ValueError: 展開できないContent-Encodingの場合
+    """
+
+    def __init__(self, content_encoding):
+        encoding = (content_encoding or "identity").strip().lower()
+        if encoding == "identity":
+            self.decoder = None
+        elif encoding in ("gzip", "x-gzip"):
+            self.decoder = zlib.decompressobj(31)
+        elif encoding == "deflate":
+            self.decoder = zlib.decompressobj()
+        elif encoding == "zstd" and zstandard is not None:
+            self.decoder = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            raise ValueError("unsupported content encoding: " + encoding)
+        self.digest = hashlib.sha256()
+        # itemsより前の部分(resourceVersionを除くため、itemsが見つかるまで保持する)
+        self.head = b""
+        # bodyを最後まで読み込んだかどうか
+        self.complete = False
+
+    def update(self, chunk):
+        """
+        bodyの断片(圧縮されたまま)をハッシュに加える。
+        """
+        data = self.decoder.decompress(chunk) if self.decoder else chunk
+        if self.head is None:
+            self.digest.update(data)
+            return
+        self.head += data
+        items_pos = self.head.find(b'"items"')
+        if items_pos >= 0:
+            self.update_head(items_pos)
+
+    def update_head(self, end):
+        """
+        itemsより前の部分を、Listのresourceversionを除いてハッシュに加える。
+        """
+        head, self.head = self.head, None
+        match = LIST_RESOURCE_VERSION.search(head, 0, end)
+        if match:
+            self.digest.update(head[:match.start(1)])
+            self.digest.update(head[match.end(1):])
+        else:
+            self.digest.update(head)
+
+    def wrap(self, chunks):
+        """
+        bodyの断片を順にハッシュに加えながら、そのまま返すジェネレータ。
+        """
+        for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+        self.complete = True
+
+    def hexdigest(self):
+        """
+        bodyを最後まで読み込んでいればハッシュを、そうでなければNoneを返す。
+        """
+        if not self.complete:
+            return None
+        if self.head is not None:
+            self.update_head(len(self.head))
+        return self.digest.hexdigest()
+
+
+def status_diff(old, new):
+    """
+    2つのstatusを比較し、変化した項目だけのmerge patchを作成する関数。
+    newに無い項目はNone(削除)とする。
+
+    :param old: 最後に書き込んだstatus
+    :param new: 現在のstatus
+    :return: merge patch(変化が無い場合は空の辞書)
+    """
+    patch = {}
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(old.get(key), dict):
+            diff = status_diff(old[key], value)
+            if diff:
+                patch[key] = diff
+        elif key not in old or old[key] != value:
+            patch[key] = copy.deepcopy(value)
+    for key in old:
+        if key not in new:
+            patch[key] = None
+    return patch
+
+
+class StatusWriter:
+    """
+    1つのCRのstatusの書き込みをまとめるクラス。
+    statusはメモリ上で更新し、処理の区切りごとに最後に書き込んだ内容との差分だけを
+    status subresourceへのmerge patchとして1回で書き込む。
+
+    :param group: APIグループ
+    :param namespace: 名前空間
+    :param version: APIバージョン
+    :param plural: リソースの複数形
+    :param name: リソース名
+    :param api: Kubernetes APIクライアント
+    :param status: CRに書き込まれているstatus
+    """
+
+    def __init__(self, group, namespace, version, plural, name, api, status):
+        self.group = group
+        self.namespace = namespace
+        self.version = version
+        self.plural = plural
+        self.name = name
+        self.api = api
+        # 最後に書き込んだstatusと書き込んだ時刻
+        self.written = copy.deepcopy(status or {})
+        self.written_at = None
+
+    def flush(self, obj, final=False):
+        """
+        statusの差分をCRに書き込む。
+        final=Falseの場合、前回の書き込みからCONTROLLER_STATUS_INTERVAL秒以内であれば
+        書き込まずに次の書き込みにまとめる。
+
+        :param obj: スプレッドシートオブジェクト
+        :param final: サイクルの最後の書き込みであるか
+        :return: 書き込み後のスプレッドシートオブジェクト
+        """
+        patch = status_diff(self.written, obj['status'])
+        if not patch:
+            return obj
+        now = time.monotonic()
+        if not final and self.written_at is not None and \
+                now - self.written_at < controller_status_interval:
+            return obj
+        try:
+            # statusの差分だけを書き込み、返されたオブジェクトをそのまま使う
+            res = self.api.patch_namespaced_custom_object_status(
+                group=self.group,
+                version=self.version,
+                namespace=self.namespace,
+                plural=self.plural,
+                name=self.name,
+                body={'status': patch}
+            )
+        except client.exceptions.ApiException as e:
+            if e.status == 404:  # CRが削除済み
+                print(f"{self.namespace}/{self.name} is not found, "
+                      "status is not updated.")
+                return obj
+            raise
+        self.written = copy.deepcopy(res.get('status', {}))
+        self.written_at = now
+        return res
+
+
+class SpreadsheetReconciler:
     """
-    このクラスはスレッドを生成して、Kubernetesのカスタムリソース（CRD）を監視し
-    変化があった場合にはaggregatorから情報を取得 -> formatterにてエクセルへ書き出し
-    の指示を行う
+    このクラスは1つのKubernetesのカスタムリソース（CRD）について
+    aggregatorから情報を取得 -> formatterにてエクセルへ書き出し
+    の指示を行う。実行のタイミングはSchedulerが管理する
 
-    :param id: スレッドID
+    :param id: ID(namespace + name)
     :param kubeAggregatorURL: kube-aggregatorのURL
     :param kubeFormatterURL: kube-formatterのURL
     :param ns: 対象とする名前空間
@@ -33,6 +278,9 @@ class StoppableThread(threading.Thread):
     :param name: リソース名
     :param obj: カスタムリソースオブジェクト
     :param api: Kubernetes APIクライアント
+    :param projection: aggregatorで適用するフィールドの射影(specのprojection)
+    :param label_selector: 対象を絞り込むlabelSelector
+    :param field_selector: 対象を絞り込むfieldSelector
     """
     # コンストラクタ
 
@@ -51,10 +299,9 @@ class StoppableThread(threading.Thread):
             name,
             obj,
             api,
-            *args,
-            **kwargs):
-        # スレッドの基本設定を初期化
-        super().__init__(*args, **kwargs)
+            projection=None,
+            label_selector=None,
+            field_selector=None):
         # 各種パラメータの設定
         self.id = id
         self.kubeAggregatorURL = kubeAggregatorURL
@@ -67,9 +314,31 @@ class StoppableThread(threading.Thread):
         self.version = version
         self.plural = plural
         self.name = name
-        self.obj = obj
+        # スプレッドシートオブジェクトの初期化
         self.api = api
-        # スレッド停止用のイベントオブジェクト
+        # statusの書き込み(初期化前のstatusを書き込み済みの内容とする)
+        self.status_writer = StatusWriter(
+            group, namespace, version, plural, name, api, obj.get('status'))
+        self.obj = self.init_spreadsheet(obj)
+        self.projection = projection or {}
+        self.label_selector = label_selector
+        self.field_selector = field_selector
+        # 最後にformatterでエクセル出力に成功したスナップショット(resourceVersion, ハッシュ, ETag)
+        self.last_resource_version = None
+        self.last_content_hash = None
+        self.last_etag = None
+        # 次回のaggregatorへの問い合わせで、複数ページのLISTにもETagを付与してもらうか
+        # (転送したbodyのハッシュを計算できなかった場合のみ)
+        self.etag_required = False
+        # 完了を待っているformatterのジョブ(ジョブID, スナップショット, 投入時刻)
+        self.pending_job = None
+        # specの変更で置き換えられた前のreconciler(最初の実行時に状態を引き継ぐ)
+        self.predecessor = None
+        # 現在のサイクルの開始時刻(time.monotonic)
+        self.cycle_started = None
+        # 最初の実行であるかのフラグ
+        self.first_cycle = True
+        # 停止用のイベントオブジェクト
         self._stop_event = threading.Event()
 
     def init_spreadsheet(self, obj):
@@ -78,8 +347,13 @@ class StoppableThread(threading.Thread):
         :param obj: スプレッドシートオブジェクト
         :return: 初期化されたスプレッドシートオブジェクト
         """
-        # 初期化済みかチェック
+        # 初期化済みかチェック(snapshotが無い場合は追加する)
         if 'status' in obj:
+            obj['status'].setdefault('snapshot', {
+                'resourceVersion': 'N/A',
+                'contentHash': 'N/A',
+                'reused': 'N/A'
+            })
             return obj
 
         # statusフィールドを初期化
@@ -100,6 +374,12 @@ class StoppableThread(threading.Thread):
                         'success': 'N/A',
                         'updateAt': 'N/A'
                     },
+                    'snapshot':
+                    {
+                        'resourceVersion': 'N/A',
+                        'contentHash': 'N/A',
+                        'reused': 'N/A'
+                    },
                     'friendlyDescription': 'N/A'
                 }
         }
@@ -108,197 +388,775 @@ class StoppableThread(threading.Thread):
 
     def stop(self):
         """
-        スレッドを停止するイベントをセットする。
+        停止するイベントをセットする。
         """
         self._stop_event.set()
 
     def stopped(self):
         """
-        スレッドが停止しているかどうかを返す。
+        停止しているかどうかを返す。
 
-        :return: スレッドが停止しているかどうか（真偽値）
+        :return: 停止しているかどうか（真偽値）
         """
         return self._stop_event.is_set()
 
-    def run(self):
+    def interval(self):
         """
-        スレッドが実行する主要な処理
+        次に実行するまでの秒数（pollingTime）を返す。0分の場合は1分とする。
 
-        この関数内でCRDに対する各種操作を実施
+        :return: 秒数
+        """
+        return max(self.minutes, 1) * 60
+
+    def aggregator_params(self):
+        """
+        aggregatorへのリクエストのクエリパラメータを作成する。
+
+        :return: クエリパラメータ（辞書）
+        """
+        params = {'kind': self.kind}
+        if self.ns != "all":
+            params['ns'] = self.ns
+        # 絞り込みはAPIサーバのLISTで行う
+        if self.label_selector:
+            params['labelSelector'] = self.label_selector
+        if self.field_selector:
+            params['fieldSelector'] = self.field_selector
+        # 射影(残すフィールドと除外するフィールド)
+        if self.projection.get('include'):
+            params['include'] = self.projection['include']
+        if self.projection.get('exclude'):
+            params['exclude'] = self.projection['exclude']
+        if self.projection.get('defaultExcludes') is False:
+            params['defaults'] = "false"
+        return params
+
+    def inherit(self, old):
+        """
+        specの変更で置き換えられる前のreconcilerを記録する。
+        前のreconcilerは実行中の場合があるため、状態は最初の実行時に引き継ぐ
+        (Schedulerは前のreconcilerの実行が終わるまで、同じIDのreconcilerを実行しない)。
+
+        :param old: 置き換えられるSpreadsheetReconciler
+        """
+        self.predecessor = old
+
+    def take_over(self, old):
+        """
+        置き換えられた前のreconcilerから、エクセル出力したスナップショットと
+        完了を待っているformatterのジョブを引き継ぐ。
+        出力の内容に関わるspec(取得条件と出力先)が同じ場合のみ引き継ぎ、
+        pollingTimeの変更などでは同じスナップショットを再度エクセル出力せず、
+        実行中のジョブも重複して投入しない。
+
+        :param old: 置き換えられたSpreadsheetReconciler
+        """
+        # 前のreconcilerも一度も実行されずに置き換えられた場合は、先にその前から引き継ぐ
+        if old.predecessor is not None:
+            old.take_over(old.predecessor)
+            old.predecessor = None
+        if old.aggregator_params() != self.aggregator_params() or \
+                old.kubeAggregatorURL != self.kubeAggregatorURL or \
+                old.kubeFormatterURL != self.kubeFormatterURL:
+            return
+        self.last_resource_version = old.last_resource_version
+        self.last_content_hash = old.last_content_hash
+        self.last_etag = old.last_etag
+        self.etag_required = old.etag_required
+        self.first_cycle = old.first_cycle
+        self.pending_job = old.pending_job
+        self.cycle_started = old.cycle_started
+
+    def unchanged(self, resource_version, content_hash):
+        """
+        aggregatorから取得したリソースが、前回エクセル出力したものから変化していないかを返す。
+
+        :param resource_version: Listのresourceversion
+        :param content_hash: Listの内容のハッシュ
+        :return: 変化していないかどうか（真偽値）
+        """
+        if resource_version and \
+                resource_version == self.last_resource_version:
+            return True
+        return bool(content_hash) and \
+            content_hash == self.last_content_hash
+
+    def record_snapshot(self, obj, resource_version, content_hash, etag):
+        """
+        エクセル出力に成功したスナップショットを記録する。
+
+        :param obj: スプレッドシートオブジェクト
+        :param resource_version: Listのresourceversion
+        :param content_hash: Listの内容のハッシュ
+        :param etag: aggregatorのレスポンスのETag
+        """
+        self.last_resource_version = resource_version
+        self.last_content_hash = content_hash
+        self.last_etag = etag
+        obj['status']['snapshot'] = {
+            'resourceVersion': resource_version or 'N/A',
+            'contentHash': content_hash or 'N/A',
+            'reused': "false"
+        }
+
+    def wait_job(self):
+        """
+        formatterのジョブの完了を最大CONTROLLER_JOB_WAIT秒待ち(long-poll)、
+        完了していればstatusに結果と処理段階ごとの所要時間、サイクル全体の所要時間を反映する。
+
+        :return: 次に実行するまでの秒数
         """
-        # スレッドの開始を報告
-        print(f"Thread ID: {self.id} has started.")
-        # スプレッドシートオブジェクトの初期化
         obj = self.obj
-        obj = self.init_spreadsheet(obj)
-
-        # 最初のループであるかのフラグ
-        firstCycleFlg = True
-
-        # スレッド停止イベントがセットされるまでループ
-        while not self.stopped():
-            # スレッド動作中の報告
-            print(f"Thread ID: {self.id} is running.")
-            # タイムアウトフラグ
-            timeout_flag = False
-
-            # aggregatorへの問い合わせ
-            if firstCycleFlg:
-                now = datetime.datetime.now()
-                obj['status']['aggregated']['startedAt'] = now.strftime(
-                    '%Y/%m/%d %H:%M:%S')
-
-            # 現在のstatusをCRDに反映
-            obj = change_status(
-                self.group,
-                self.namespace,
-                self.version,
-                self.plural,
-                self.name,
-                obj,
-                self.api)
-            if self.ns == "all":
-                query = "?kind=" + self.kind
-            else:
-                query = "?ns=" + self.ns + "&kind=" + self.kind
-            url = self.kubeAggregatorURL + "/api/v1/resource" + query
-            # aggregatorからデータを取得する
-            try:
-                res = requests.get(url=url, verify=False, timeout=3.0)
-            except Timeout:
-                print(f"Thread ID: {self.id} aggregator request timed out.")
-                timeout_flag = True
-                pass
+        job = self.pending_job
+        url = self.kubeFormatterURL + "/api/v1/jobs/" + job['id']
+        result = None
+        try:
+            res = requests.get(
+                url=url,
+                params={'wait': controller_job_wait},
+                verify=False,
+                timeout=(3.0, controller_job_wait + 30.0))
+            if res.status_code == 200:
+                result = res.json()
+            elif res.status_code == 404:  # formatterの再起動などでジョブが無い
+                result = {'state': "failed", 'error': "job not found"}
+        except requests.exceptions.RequestException as e:
+            print(f"Thread ID: {self.id} job request failed. {e!r}")
+
+        if result is None or result['state'] not in ("done", "failed"):
+            # 完了していない場合は、ワーカーを空けてから再度問い合わせる
+            if time.monotonic() - job['submittedAt'] < \
+                    controller_job_timeout:
+                return 0 if result is not None else controller_job_wait
+            result = {'state': "failed", 'error': "Timeout"}
+
+        self.pending_job = None
+        # Update日時の設定
+        now = datetime.datetime.now()
+        obj['status']['formatted']['updateAt'] = now.strftime(
+            '%Y/%m/%d %H:%M:%S')
+        # 処理段階ごとの所要時間(キューで待った時間を含む)
+        stages = dict(result.get('stages') or {})
+        if result.get('queueSeconds') is not None:
+            stages['queue'] = result['queueSeconds']
+        obj['status']['formatted']['stages'] = stages
+        if result['state'] == "done":
+            obj['status']['formatted']['success'] = "true"
+            obj['status']['friendlyDescription'] = "Reconcile Succeeded"
+            self.record_snapshot(
+                obj, job['resourceVersion'], job['contentHash'], job['etag'])
+        else:
+            obj['status']['formatted']['success'] = "false"
+            obj['status']['formatted']['error'] = \
+                result.get('error') or "job failed"
+            obj['status']['friendlyDescription'] = \
+                "Reconcile Failed : formatted"
+        # aggregatorへの問い合わせからエクセル出力の完了までの秒数
+        latency = time.monotonic() - self.cycle_started
+        obj['status']['latencySeconds'] = round(latency, 3)
+        # 現在のstatusをCRDに反映(このサイクルの最後の書き込み)
+        obj = self.status_writer.flush(obj, final=True)
+
+        print(f"Thread ID: {self.id} job {job['id']} has {result['state']}. "
+              f"({latency:.1f}s)")
+        print(f"Thread ID: {self.id} is sleeping for {self.minutes}m.")
+        self.obj = obj
+        # サイクルの開始からpollingTime後に再実行
+        return max(self.interval() - latency, 0)
 
-            # Update日時の設定
+    def request_body(self, res, hasher=None):
+        """
+        aggregatorのレスポンスから、formatterへ送るbodyとContent-Encodingを作成する。
+        圧縮されたbodyは展開せずに(圧縮されたまま)そのまま転送する。
+        圧縮されていない場合は、大きければgzipで圧縮する。
+
+        :param res: aggregatorのレスポンス(stream=True)
+        :param hasher: 転送するbodyのハッシュを計算するContentHasher(省略可)
+        :return: (body, Content-Encoding)
+        """
+        content_encoding = res.headers.get("Content-Encoding")
+        gzip_enabled = not content_encoding and controller_gzip_level > 0
+
+        if not controller_relay:
+            # 全てbytesのまま読み込んでから送る
+            body = res.raw.read(decode_content=False)
+            if hasher is not None:
+                body = b"".join(hasher.wrap([body]))
+            if gzip_enabled and len(body) >= controller_compress_min_size:
+                return gzip.compress(body, controller_gzip_level), "gzip"
+            return body, content_encoding
+
+        # 読み込んだ分から順にformatterへ送る(サイズが分からない場合は圧縮する)
+        chunks = res.raw.stream(
+            controller_relay_chunk_size, decode_content=False)
+        if hasher is not None:
+            chunks = hasher.wrap(chunks)
+        length = res.headers.get("Content-Length")
+        if gzip_enabled and (length is None or
+                             int(length) >= controller_compress_min_size):
+            return gzip_stream(chunks), "gzip"
+        return chunks, content_encoding
+
+    def reconcile(self):
+        """
+        1回分の処理(aggregatorから情報を取得 -> formatterにてエクセルへ書き出し)
+
+        スケジューラのワーカーから呼び出され、次に実行するまでの秒数を返す
+
+        :return: 次に実行するまでの秒数
+        """
+        obj = self.obj
+        # 停止済みの場合は何もしない
+        if self.stopped():
+            return None
+        # 置き換えられた前のreconcilerの状態を引き継ぐ
+        if self.predecessor is not None:
+            self.take_over(self.predecessor)
+            self.predecessor = None
+        # formatterのジョブの完了を待っている場合は、ジョブの状態を問い合わせる
+        if self.pending_job is not None:
+            return self.wait_job()
+        # 実行中の報告
+        print(f"Thread ID: {self.id} is running.")
+        self.cycle_started = time.monotonic()
+        # タイムアウトフラグ
+        timeout_flag = False
+
+        # aggregatorへの問い合わせ
+        if self.first_cycle:
             now = datetime.datetime.now()
-            obj['status']['aggregated']['updateAt'] = now.strftime(
+            obj['status']['aggregated']['startedAt'] = now.strftime(
                 '%Y/%m/%d %H:%M:%S')
-            # リクエスト結果
-            if timeout_flag:
-                obj['status']['aggregated']['success'] = "false"
-                obj['status']['aggregated']['error'] = "Timeout"
-                obj['status']['friendlyDescription'] = \
-                    "Reconcile Failed : aggregated"
-                obj = change_status(
-                    self.group,
-                    self.namespace,
-                    self.version,
-                    self.plural,
-                    self.name,
-                    obj,
-                    self.api)
-                time.sleep(self.minutes * 60)  # CRD の pollingTime 分待つ
-                continue
-            elif res.status_code == 200:
-                obj['status']['aggregated']['success'] = "true"
-                # 現在のstatusをCRDに反映
-                obj = change_status(
-                    self.group,
-                    self.namespace,
-                    self.version,
-                    self.plural,
-                    self.name,
-                    obj,
-                    self.api)
-            else:
-                obj['status']['aggregated']['success'] = "false"
-                obj['status']['aggregated']['error'] = "status code is " + \
-                    str(res.status_code)
-                obj['status']['friendlyDescription'] = \
-                    "Reconcile Failed : aggregated"
-                # 現在のstatusをCRDに反映
-                obj = change_status(
-                    self.group,
-                    self.namespace,
-                    self.version,
-                    self.plural,
-                    self.name,
-                    obj,
-                    self.api)
-                time.sleep(self.minutes * 60)  # CRD の pollingTime 分待つ
-                continue
 
-            # formatter問い合わせ
-            if firstCycleFlg:
-                now = datetime.datetime.now()
-                obj['status']['formatted']['startedAt'] = now.strftime(
-                    '%Y/%m/%d %H:%M:%S')
-                firstCycleFlg = False
-
-            # 現在のstatusをCRDに反映
-            obj = change_status(
-                self.group,
-                self.namespace,
-                self.version,
-                self.plural,
-                self.name,
-                obj,
-                self.api)
-            # POST情報の設定
-            url = self.kubeFormatterURL + "/api/v1/resource"
-            headers = {
-                'content-type': 'application/json'
-            }
-            json_data = res.text
-            param = {
-                'id': self.id
-            }
-            # formatter POST
-            try:
-                res = requests.post(
-                    url=url,
-                    headers=headers,
-                    data=json_data,
-                    verify=False,
-                    params=param,
-                    timeout=(
-                        3.0,
-                        300.0))
-            except Timeout:
-                timeout_flag = True
-                pass
-
-            # Update日時の設定
+        url = self.kubeAggregatorURL + "/api/v1/resource"
+        # 前回エクセル出力したスナップショットのETagを送り、変化が無ければ304を受け取る
+        headers = {'Accept-Encoding': controller_accept_encoding}
+        if self.last_etag:
+            headers['If-None-Match'] = self.last_etag
+        # 再検証するETagがある場合のみ、LISTが複数ページの場合もETagを付与してもらう
+        # (aggregatorは全ページを一時ファイルに書き出してからハッシュを計算するため、
+        #  それ以外の場合はストリーミングで受け取り、ハッシュは転送しながら計算する)
+        params = self.aggregator_params()
+        if self.last_etag or self.etag_required:
+            params['etag'] = "true"
+        # aggregatorからデータを取得する
+        try:
+            res = requests.get(
+                url=url,
+                params=params,
+                headers=headers,
+                verify=False,
+                stream=True,
+                timeout=(3.0, 60.0))
+        except Timeout:
+            print(f"Thread ID: {self.id} aggregator request timed out.")
+            timeout_flag = True
+            pass
+
+        # Update日時の設定
+        now = datetime.datetime.now()
+        obj['status']['aggregated']['updateAt'] = now.strftime(
+            '%Y/%m/%d %H:%M:%S')
+        # リクエスト結果
+        if timeout_flag:
+            obj['status']['aggregated']['success'] = "false"
+            obj['status']['aggregated']['error'] = "Timeout"
+            obj['status']['friendlyDescription'] = \
+                "Reconcile Failed : aggregated"
+            # 現在のstatusをCRDに反映(このサイクルの最後の書き込み)
+            obj = self.status_writer.flush(obj, final=True)
+            print(f"Thread ID: {self.id} is sleeping for {self.minutes}m.")
+            self.obj = obj
+            return self.interval()  # CRD の pollingTime 後に再実行
+        elif res.status_code in (200, 304):
+            obj['status']['aggregated']['success'] = "true"
+            # aggregatorの区切りでstatusを反映(間隔が短ければ次の書き込みにまとめる)
+            obj = self.status_writer.flush(obj)
+        else:
+            res.close()
+            obj['status']['aggregated']['success'] = "false"
+            obj['status']['aggregated']['error'] = "status code is " + \
+                str(res.status_code)
+            obj['status']['friendlyDescription'] = \
+                "Reconcile Failed : aggregated"
+            # 現在のstatusをCRDに反映(このサイクルの最後の書き込み)
+            obj = self.status_writer.flush(obj, final=True)
+            print(f"Thread ID: {self.id} is sleeping for {self.minutes}m.")
+            self.obj = obj
+            return self.interval()  # CRD の pollingTime 後に再実行
+
+        # 前回エクセル出力したスナップショットから変化が無い場合、formatterを呼び出さない
+        # (304の場合はbodyが無い)
+        resource_version = res.headers.get("X-Resource-Version")
+        content_hash = res.headers.get("X-Content-Hash")
+        etag = res.headers.get("ETag")
+        if res.status_code == 304 or \
+                self.unchanged(resource_version, content_hash):
+            res.close()
+            print(f"Thread ID: {self.id} snapshot is unchanged.")
+            obj['status']['snapshot']['reused'] = "true"
+            obj['status']['friendlyDescription'] = \
+                "Reconcile Succeeded : snapshot reused"
+            # 現在のstatusをCRDに反映(このサイクルの最後の書き込み)
+            obj = self.status_writer.flush(obj, final=True)
+            print(f"Thread ID: {self.id} is sleeping for {self.minutes}m.")
+            self.obj = obj
+            return self.interval()  # CRD の pollingTime 後に再実行
+
+        # formatter問い合わせ
+        if self.first_cycle:
             now = datetime.datetime.now()
-            obj['status']['formatted']['updateAt'] = now.strftime(
+            obj['status']['formatted']['startedAt'] = now.strftime(
                 '%Y/%m/%d %H:%M:%S')
-            # リクエスト結果
-            if timeout_flag:
-                obj['status']['formatted']['success'] = "false"
-                obj['status']['formatted']['error'] = "Timeout"
-                obj['status']['friendlyDescription'] = \
-                    "Reconcile Failed : formatted"
-            elif res.status_code == 200:
-                obj['status']['formatted']['success'] = "true"
-                obj['status']['friendlyDescription'] = "Reconcile Succeeded"
+            self.first_cycle = False
+
+        # POST情報の設定
+        url = self.kubeFormatterURL + "/api/v1/resource"
+        headers = {
+            'content-type': 'application/json'
+        }
+        # ETagが無い場合(複数ページのLISTのストリーミング)は、転送しながらハッシュを計算する
+        hasher = None
+        if not etag:
+            try:
+                hasher = ContentHasher(res.headers.get("Content-Encoding"))
+            except ValueError as e:
+                print(f"Thread ID: {self.id} content hash is unavailable. "
+                      f"{e}")
+        # aggregatorのレスポンスのbytesをformatterへ転送する
+        body, content_encoding = self.request_body(res, hasher)
+        if content_encoding:
+            headers['Content-Encoding'] = content_encoding
+        param = {
+            'id': self.id
+        }
+        relay_error = None
+        aggregator_res = res
+        # formatter POST
+        try:
+            res = requests.post(
+                url=url,
+                headers=headers,
+                data=body,
+                verify=False,
+                params=param,
+                timeout=(
+                    3.0,
+                    300.0))
+        except Timeout:
+            timeout_flag = True
+            pass
+        except (requests.exceptions.RequestException,
+                urllib3.exceptions.HTTPError) as e:
+            # 転送中のaggregatorまたはformatterとの接続断
+            print(f"Thread ID: {self.id} relay failed. {e!r}")
+            relay_error = type(e).__name__
+        finally:
+            aggregator_res.close()
+
+        # Update日時の設定
+        now = datetime.datetime.now()
+        obj['status']['formatted']['updateAt'] = now.strftime(
+            '%Y/%m/%d %H:%M:%S')
+        # リクエスト結果
+        if timeout_flag:
+            obj['status']['formatted']['success'] = "false"
+            obj['status']['formatted']['error'] = "Timeout"
+            obj['status']['friendlyDescription'] = \
+                "Reconcile Failed : formatted"
+        elif relay_error:
+            obj['status']['formatted']['success'] = "false"
+            obj['status']['formatted']['error'] = relay_error
+            obj['status']['friendlyDescription'] = \
+                "Reconcile Failed : formatted"
+        elif res.status_code == 202:
+            # formatterのジョブとして受け付けられた。完了はwait_jobで確認する
+            job_id = res.json()['id']
+            print(f"Thread ID: {self.id} job {job_id} is accepted.")
+            # 転送しながら計算したハッシュから、aggregatorと同じETagを作成する
+            if hasher is not None and hasher.hexdigest():
+                content_hash = hasher.hexdigest()
+                etag = 'W/"' + content_hash + '"'
+            # ハッシュが得られなかった場合は、次回はaggregatorにETagを付与してもらう
+            self.etag_required = not etag
+            self.pending_job = {
+                'id': job_id,
+                'resourceVersion': resource_version,
+                'contentHash': content_hash,
+                'etag': etag,
+                'submittedAt': time.monotonic()
+            }
+            obj['status']['formatted']['jobId'] = job_id
+            obj['status']['friendlyDescription'] = \
+                "Reconcile Running : formatted"
+            # formatterの区切りでstatusを反映(間隔が短ければ次の書き込みにまとめる)
+            obj = self.status_writer.flush(obj)
+            self.obj = obj
+            return 0  # ワーカーを空けてからジョブの完了を待つ
+        elif res.status_code == 200:
+            # ジョブIDを返さないformatterの場合は、受け付けられた時点で成功とする
+            # (エクセル出力の結果は分からないため、スナップショットは記録せず次回も送る)
+            obj['status']['formatted']['success'] = "true"
+            obj['status']['friendlyDescription'] = "Reconcile Succeeded"
+        elif res.status_code == 503:
+            # formatterのキューが一杯の場合は、Retry-After秒後に再実行する
+            obj['status']['formatted']['success'] = "false"
+            obj['status']['formatted']['error'] = "status code is 503"
+            obj['status']['friendlyDescription'] = \
+                "Reconcile Failed : formatted"
+            obj = self.status_writer.flush(obj, final=True)
+            retry_after = res.headers.get("Retry-After", "")
+            print(f"Thread ID: {self.id} formatter is busy. "
+                  f"Retry-After: {retry_after or 'N/A'}")
+            self.obj = obj
+            if retry_after.isdigit():
+                return min(int(retry_after), self.interval())
+            return self.interval()
+        else:
+            obj['status']['formatted']['success'] = "false"
+            obj['status']['formatted']['error'] = "status code is " + \
+                str(res.status_code)
+            obj['status']['friendlyDescription'] = \
+                "Reconcile Failed : formatted"
+        # 現在のstatusをCRDに反映(このサイクルの最後の書き込み)
+        obj = self.status_writer.flush(obj, final=True)
+
+        print(f"Thread ID: {self.id} is sleeping for {self.minutes}m.")
+        self.obj = obj
+        return self.interval()  # CRD の pollingTime 後に再実行
+
+
+class Scheduler:
+    """
+    このクラスはすべてのSpreadsheetを、次の実行時刻をキーとした1つの優先度付きキューで管理し、
+    実行時刻になったものを上限付きのワーカープールでreconcileする
+
+    登録・削除・specの変更時はすぐに起床するため、停止や変更の反映を待たせない
+
+    :param workers: ワーカースレッド数（同時に実行するreconcileの数）
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="reconcile")
+        self.cond = threading.Condition()
+        # (実行時刻, 連番, reconciler)のヒープ
+        self.queue = []
+        self.counter = itertools.count()
+        # IDをキーとした登録中のSpreadsheetReconciler
+        self.reconcilers = {}
+        # 実行中のID
+        self.running = set()
+        # メトリクス
+        self.reconciles = 0
+        self.failures = 0
+        self.max_lag = 0.0
+
+    def add(self, reconciler):
+        """
+        reconcilerを登録し、すぐに実行する。同じIDがあれば停止して置き換える
+        (エクセル出力したスナップショットは引き継ぐ)。
+
+        :param reconciler: SpreadsheetReconciler
+        """
+        with self.cond:
+            old = self.reconcilers.get(reconciler.id)
+            if old is not None:
+                old.stop()
+                reconciler.inherit(old)
+            self.reconcilers[reconciler.id] = reconciler
+            self.push(reconciler, time.monotonic())
+
+    def remove(self, id):
+        """
+        IDのreconcilerを停止して登録を解除する。
+
+        :param id: ID
+        """
+        with self.cond:
+            reconciler = self.reconcilers.pop(id, None)
+            if reconciler is not None:
+                reconciler.stop()
+                print(f"Thread ID: {id} has finished. ")
+            self.cond.notify()
+
+    def push(self, reconciler, at):
+        """
+        reconcilerを実行時刻atでキューに追加する（self.condを取得した状態で呼び出す）。
+        """
+        heapq.heappush(self.queue, (at, next(self.counter), reconciler))
+        self.cond.notify()
+
+    def registered(self, reconciler):
+        """
+        reconcilerが登録中（停止・置き換えされていない）かどうかを返す。
+        """
+        return self.reconcilers.get(reconciler.id) is reconciler
+
+    def run(self):
+        """
+        実行時刻になったreconcilerを、ワーカーに空きがあればワーカープールで実行する。
+        """
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    # 停止・置き換えされたreconcilerは取り除く
+                    while self.queue and \
+                            not self.registered(self.queue[0][2]):
+                        heapq.heappop(self.queue)
+                    if self.queue and self.queue[0][0] <= now and \
+                            len(self.running) < self.workers:
+                        break
+                    if self.queue and len(self.running) < self.workers:
+                        self.cond.wait(self.queue[0][0] - now)
+                    else:
+                        self.cond.wait()
+                at, _, reconciler = heapq.heappop(self.queue)
+                # 置き換え前のreconcilerが実行中の場合は、終わるまで待つ
+                if reconciler.id in self.running:
+                    self.push(reconciler, now + 1)
+                    continue
+                self.running.add(reconciler.id)
+                self.reconciles += 1
+                self.max_lag = max(self.max_lag, now - at)
+            self.executor.submit(self.execute, reconciler)
+
+    def execute(self, reconciler):
+        """
+        reconcileを1回実行し、次の実行時刻でキューに戻す（ワーカースレッドで実行）。
+        例外で失敗した場合はCONTROLLER_RETRY_INTERVAL秒後に再実行する。
+        """
+        delay = None
+        try:
+            delay = reconciler.reconcile()
+        except Exception as e:
+            print(f"Thread ID: {reconciler.id} reconcile failed. {e!r}")
+            self.failures += 1
+            delay = controller_retry_interval
+        finally:
+            with self.cond:
+                self.running.discard(reconciler.id)
+                if delay is not None and self.registered(reconciler):
+                    self.push(reconciler, time.monotonic() + delay)
+                self.cond.notify()
+
+    def metrics(self):
+        """
+        スケジューラのメトリクスを返す。
+
+        :return: メトリクス名をキーとした値（辞書）
+        """
+        with self.cond:
+            now = time.monotonic()
+            due = [at for at, _, r in self.queue
+                   if at <= now and self.registered(r)]
+            return {
+                # 登録中のSpreadsheetの数
+                "controller_spreadsheets": len(self.reconcilers),
+                # 実行時刻を過ぎてワーカーの空きを待っている数
+                "controller_queue_depth": len(due),
+                "controller_running": len(self.running),
+                "controller_workers": self.workers,
+                # 待っているもののうち最も古いものの遅れ（秒）
+                "controller_schedule_lag_seconds":
+                    now - min(due) if due else 0.0,
+                # 実行開始時の遅れの最大値（秒）
+                "controller_schedule_lag_seconds_max": self.max_lag,
+                "controller_reconciles_total": self.reconciles,
+                "controller_reconcile_failures_total": self.failures,
+            }
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    スケジューラのメトリクスをPrometheusのテキスト形式で返すハンドラ(/metrics)
+    """
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = "".join(
+            f"{name} {value}\n"
+            for name, value in self.server.scheduler.metrics().items()
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # アクセスログは出力しない
+        pass
+
+
+def start_metrics_server(scheduler):
+    """
+    メトリクスを公開するHTTPサーバをデーモンスレッドで開始する関数。
+    """
+    if controller_metrics_port <= 0:
+        return
+    server = http.server.ThreadingHTTPServer(
+        ("", controller_metrics_port), MetricsHandler)
+    server.scheduler = scheduler
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def create_reconciler(obj, group, namespace, version, plural, api):
+    """
+    カスタムリソースのspecからSpreadsheetReconcilerを生成する関数。
+    """
+    spec = obj['spec']
+    name = obj['metadata']['name']
+    return SpreadsheetReconciler(
+        namespace + name,
+        spec['kubeAggregatorURL'],
+        spec['kubeFormatterURL'],
+        spec['targetNamespace'],
+        spec['scrapeResource'],
+        format_pollingtime(spec['pollingTime']),
+        group,
+        namespace,
+        version,
+        plural,
+        name,
+        obj,
+        api,
+        spec.get('projection'),
+        spec.get('labelSelector'),
+        spec.get('fieldSelector'))
+
+
+class SpreadsheetWatcher:
+    """
+    このクラスはSpreadsheetの一覧の取得(LIST)と変更の監視(WATCH)を行い、
+    スケジューラへの登録・置き換え・削除を行う
+
+    最後に受け取ったresourceVersionを記録し(BOOKMARKも受け取る)、
+    watchが終了・切断された場合はそこから再開する。
+    一覧の取得し直しはresourceVersionが古すぎる(410 Gone)場合のみ行う
+
+    :param scheduler: Scheduler
+    :param api: Kubernetes APIクライアント
+    :param group: APIグループ
+    :param namespace: 名前空間
+    :param version: APIバージョン
+    :param plural: リソースの複数形
+    """
+
+    def __init__(self, scheduler, api, group, namespace, version, plural):
+        self.scheduler = scheduler
+        self.api = api
+        self.group = group
+        self.namespace = namespace
+        self.version = version
+        self.plural = plural
+        # 最後に受け取ったresourceVersion(Noneの場合は一覧から取得し直す)
+        self.resource_version = None
+        # IDをキーとした、登録中のSpreadsheetのspec
+        self.specs = {}
+
+    def apply(self, operation, obj):
+        """
+        Spreadsheetの追加・変更・削除をスケジューラに反映する。
+
+        :param operation: イベントの種類(ADDED, MODIFIED, DELETED)
+        :param obj: カスタムリソースオブジェクト
+        """
+        id = self.namespace + obj['metadata']['name']
+        spec = obj.get('spec')
+
+        if operation == "DELETED":
+            # 停止してスケジューラから削除
+            self.specs.pop(id, None)
+            self.scheduler.remove(id)
+        elif spec and operation in ("ADDED", "MODIFIED"):
+            # statusの更新によるMODIFIEDは無視し、specが変わった場合のみ置き換える
+            if self.specs.get(id) == spec:
+                return
+            if id in self.specs:
+                print(f"Thread ID: {id} spec is changed.")
             else:
-                obj['status']['formatted']['success'] = "false"
-                obj['status']['formatted']['error'] = "status code is " + \
-                    str(res.status_code)
-                obj['status']['friendlyDescription'] = \
-                    "Reconcile Failed : formatted"
-            # 現在のstatusをCRDに反映
-            obj = change_status(
-                self.group,
-                self.namespace,
-                self.version,
-                self.plural,
-                self.name,
-                obj,
-                self.api)
-
-            # スレッドを一定時間停止（ポーリング間隔に基づく）
-            print(f"Thread ID: {self.id} is sleeping for {self.minutes}m.")
-            time.sleep(self.minutes * 60)  # CRD の pollingTime 分待つ
+                print(f"Thread ID: {id} has started.")
+            self.specs[id] = spec
+            self.scheduler.add(create_reconciler(
+                obj, self.group, self.namespace, self.version, self.plural,
+                self.api))
+
+    def relist(self):
+        """
+        Spreadsheetの一覧を取得してスケジューラと同期し、resourceVersionを記録する。
+        一覧に無いもの(監視していない間に削除されたもの)は削除する。
+        """
+        res = self.api.list_namespaced_custom_object(
+            group=self.group,
+            namespace=self.namespace,
+            version=self.version,
+            plural=self.plural)
+        ids = set()
+        for obj in res.get('items', []):
+            ids.add(self.namespace + obj['metadata']['name'])
+            self.apply("ADDED", obj)
+        for id in list(self.specs):
+            if id not in ids:
+                self.specs.pop(id)
+                self.scheduler.remove(id)
+        self.resource_version = res['metadata']['resourceVersion']
+        print(f"Spreadsheets are listed. count: {len(ids)}, "
+              f"resourceVersion: {self.resource_version}")
+
+    def watch(self):
+        """
+        記録したresourceVersionからSpreadsheetの変更を監視する。
+        CONTROLLER_WATCH_TIMEOUT秒で終了する。
+        """
+        stream = watch.Watch().stream(
+            self.api.list_namespaced_custom_object,
+            group=self.group,
+            namespace=self.namespace,
+            version=self.version,
+            plural=self.plural,
+            resource_version=self.resource_version,
+            allow_watch_bookmarks=True,
+            timeout_seconds=controller_watch_timeout)
 
-        # スレッドの終了を報告
-        print(f"Thread ID: {self.id} has finished. ")
+        for event in stream:
+            # イベントごとにresourceVersionを記録し、スケジューラへ反映
+            metadata = event['raw_object'].get('metadata', {})
+            if metadata.get('resourceVersion'):
+                self.resource_version = metadata['resourceVersion']
+            if event['type'] == "BOOKMARK":
+                continue
+            self.apply(event['type'], event['raw_object'])
+
+    def run(self):
+        """
+        一覧の取得と変更の監視を繰り返す。
+        """
+        while True:
+            try:
+                if self.resource_version is None:
+                    self.relist()
+                self.watch()
+            except client.exceptions.ApiException as e:
+                if e.status == 410:  # resourceVersionが古すぎる
+                    print("resourceVersion is too old, relisting "
+                          "Spreadsheets.")
+                    self.resource_version = None
+                    continue
+                print(f"watch failed. {e.status} {e.reason}")
+                time.sleep(controller_watch_retry_interval)
+            except Exception as e:  # 接続断など
+                print(f"watch is disconnected. {e!r}")
+                time.sleep(controller_watch_retry_interval)
 
 
 def read_crd():
     """
-    Kubernetesのカスタムリソースを読み込み、スレッドを生成・管理する関数。
+    Kubernetesのカスタムリソースを読み込み、スケジューラに登録・削除する関数。
     """
     # Kubernetes上で動いているかを環境変数から判断
     if os.getenv('KUBERNETES_SERVICE_HOST'):
@@ -317,92 +1175,14 @@ def read_crd():
     version = "v1alpha1"
     plural = "spreadsheet"
 
-    # カスタムリソースの変更を監視
-    stream = watch.Watch().stream(
-        api.list_namespaced_custom_object,
-        group=group,
-        namespace=namespace,
-        version=version,
-        plural=plural)
-
-    threads = {}
-
-    for event in stream:
-        # イベントごとにスレッドを制御
-        obj = event['object']
-        operation = event['type']
-        spec = obj.get('spec')
-
-        if spec:
-            name = obj['metadata']['name']
-
-            if operation == "ADDED":
-                minutes = format_pollingtime(spec['pollingTime'])
-                # スレッドを動的に生成
-                thread = StoppableThread(
-                    namespace + name,
-                    spec['kubeAggregatorURL'],
-                    spec['kubeFormatterURL'],
-                    spec['targetNamespace'],
-                    spec['scrapeResource'],
-                    minutes,
-                    group,
-                    namespace,
-                    version,
-                    plural,
-                    name,
-                    obj,
-                    api)
-                # スレッドを辞書型に追加
-                threads[namespace + name] = thread
-                # スレッドを開始
-                thread.start()
-
-            elif operation == "DELETED":
-                # 特定のスレッドを停止
-                threads[namespace + name].stop()
-
-
-def change_status(group, namespace, version, plural, name, obj, api):
-    """
-    カスタムリソースのstatusフィールドを更新する関数。
-    """
-    retry_count = 5
+    # すべてのSpreadsheetを1つのスケジューラとワーカープールで処理する
+    scheduler = Scheduler(controller_workers)
+    threading.Thread(target=scheduler.run, daemon=True).start()
+    start_metrics_server(scheduler)
 
-    for _ in range(retry_count):
-        try:
-            # CRDのstatusフィールドを更新
-            api.patch_namespaced_custom_object_status(
-                group=group,
-                version=version,
-                namespace=namespace,
-                plural=plural,
-                name=name,
-                body=obj
-            )
-            # 更新後のオブジェクトを取得
-            obj = api.get_namespaced_custom_object(
-                group=group,
-                version=version,
-                namespace=namespace,
-                plural=plural,
-                name=name,
-            )
-            break
-        except client.exceptions.ApiException as e:
-            if e.status == 409:  # 競合発生
-                print("Conflict occurred when updating status, retrying...")
-                # 競合解消のため、最新のオブジェクトを取得
-                obj = api.get_namespaced_custom_object(
-                    group=group,
-                    version=version,
-                    namespace=namespace,
-                    plural=plural,
-                    name=name,
-                )
-            else:
-                raise  # 競合以外のエラーは再スロー
-    return obj
+    # カスタムリソースの一覧の取得と変更の監視
+    SpreadsheetWatcher(
+        scheduler, api, group, namespace, version, plural).run()
 
 
 def format_pollingtime(pollingtime):
@@ -423,6 +1203,6 @@ def format_pollingtime(pollingtime):
 
 if __name__ == "__main__":
     """
-    メインの処理。Kubernetesのカスタムリソースを読み込み、それに基づいてスレッドを生成・管理する。
+    メインの処理。Kubernetesのカスタムリソースを読み込み、それに基づいてreconcileを管理する。
     """
     read_crd()
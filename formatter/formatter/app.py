@@ -1,14 +1,50 @@
 # 必要なライブラリとモジュールをインポート
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse
 import pandas
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
 import os
 import json
 import datetime
 import boto3
+import boto3.s3.transfer
+import botocore.config
+import botocore.exceptions
 import uvicorn
 import sys
 import threading
+try:
+    # 高速なjsonパーサ。インストールされていない場合は標準のjsonを使う
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    # itemsを1件ずつパースするためのjsonパーサ
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    # zstdで圧縮されたリクエストの展開用。インストールされていない場合はgzipのみ受け付ける
+    import zstandard
+except ImportError:
+    zstandard = None
+import zlib
+# 圧縮されたbodyの展開に失敗した場合の例外
+BODY_DECODE_ERRORS = (zlib.error,) + \
+    ((zstandard.ZstdError,) if zstandard is not None else ())
+import queue
+import collections
+import time
+import uuid
+import tempfile
+import io
+import shutil
+import math
+import itertools
+import multiprocessing
+import concurrent.futures
 
 # 標準入出力ストリームのバッファリングを調整し、kubectl logs時、バッファに溜まらないように設定
 sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', buffering=1)
@@ -18,348 +54,1136 @@ sys.stdin = os.fdopen(sys.stdin.fileno(), 'r', buffering=1)
 # 出力ディレクトリの設定
 output_dir = './output'
 
+# エクセルの書式(全セルで共通のものを使い回す)
+EXCEL_THIN_BORDER = Side(style="thin")
+EXCEL_HEADER_STYLE = {
+    "font": Font(bold=True),
+    "border": Border(
+        left=EXCEL_THIN_BORDER, right=EXCEL_THIN_BORDER,
+        top=EXCEL_THIN_BORDER, bottom=EXCEL_THIN_BORDER),
+    "alignment": Alignment(horizontal="center", vertical="top"),
+}
+EXCEL_KEY_STYLE = {
+    "fill": PatternFill(fill_type="solid", fgColor="FFDDDDDD"),
+}
+EXCEL_VALUE_STYLE = {
+    "fill": PatternFill(fill_type="solid", fgColor="FFFFFFD1"),
+}
+
 # FastAPIのアプリケーションインスタンスを生成
 app = FastAPI()
 
-# スレッドクラスの定義
+# ジョブスケジューラの設定
+# FORMATTER_WORKERS: 同時に実行するExcel出力処理の数
+# FORMATTER_QUEUE_SIZE: 実行待ちにできるジョブの数。超えた場合は503を返す
+# FORMATTER_RETRY_AFTER: 503応答時にRetry-Afterとして返す秒数
+# FORMATTER_JOB_HISTORY: 状態を保持しておく完了済みジョブの数
+formatter_workers = int(os.environ.get('FORMATTER_WORKERS', '2'))
+formatter_queue_size = int(os.environ.get('FORMATTER_QUEUE_SIZE', '10'))
+formatter_retry_after = int(os.environ.get('FORMATTER_RETRY_AFTER', '30'))
+formatter_job_history = int(os.environ.get('FORMATTER_JOB_HISTORY', '100'))
+# FORMATTER_MAX_WAIT: ジョブの状態の問い合わせで、完了を待つことができる最大秒数(?wait=)
+formatter_max_wait = float(os.environ.get('FORMATTER_MAX_WAIT', '30'))
+
+# レポート作成処理の実行方式の設定
+# FORMATTER_EXECUTOR: thread(ワーカースレッド内で実行) または process(プロセスプールで実行)
+# FORMATTER_PROCESSES: プロセスプールのプロセス数。未指定の場合はコンテナのCPU quotaから算出
+# FORMATTER_CHUNK_ITEMS: itemsがこの件数を超える場合、展開処理を分割してプロセスプールで実行
+formatter_executor = os.environ.get('FORMATTER_EXECUTOR', 'thread')
+formatter_processes = int(os.environ.get('FORMATTER_PROCESSES', '0'))
+formatter_chunk_items = int(os.environ.get('FORMATTER_CHUNK_ITEMS', '200'))
+
+# 出力ファイルの保存の設定
+# FORMATTER_PERSIST: trueの場合、jsonとxlsxを出力ディレクトリに保存してからアップロードする。
+#   falseの場合、ローカルには保存せずメモリ上のバッファから直接アップロードする
+# FORMATTER_SPOOL_MAX_SIZE: バッファをメモリ上に保持する最大サイズ(byte)。超えると一時ファイルを使う
+formatter_persist = os.environ.get(
+    'FORMATTER_PERSIST', 'true').lower() == 'true'
+formatter_spool_max_size = int(
+    os.environ.get('FORMATTER_SPOOL_MAX_SIZE', str(64 * 1024 * 1024)))
+
+# FORMATTER_STREAMING: trueの場合、受け取ったjsonをパースせずにバッファへ保存し、
+#   ワーカーがitemsを1件ずつパースして展開・マージする(ijsonが必要)
+formatter_streaming = os.environ.get(
+    'FORMATTER_STREAMING', 'false').lower() == 'true'
+# FORMATTER_MAX_BODY_SIZE: 受け付けるリクエストのbodyの最大サイズ(展開後のbyte)。
+#   超えた場合は413を返す(圧縮されたbodyが展開後に巨大になる場合の対策)
+formatter_max_body_size = int(
+    os.environ.get('FORMATTER_MAX_BODY_SIZE', str(1024 * 1024 * 1024)))
+
+
+class Job:
+    """
+    Excel出力処理の1回分を表すクラス
+
+    Attributes:
+        id (str): ジョブID
+        name (str): ジョブ名(出力ファイル名)
+        input (any): 処理する入力データ
+        output (str): 出力先のファイルパス
+        state (str): queued, running, done, failedのいずれか
+        error (str): 失敗した場合のエラー内容
+        stages (dict): 処理段階ごとの所要時間(秒)
+        finished (Event): 完了(done, failed)した時にセットされるイベント
+    """
+
+    def __init__(self, name, input, output):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.input = input
+        self.output = output
+        self.state = "queued"
+        self.error = None
+        self.stages = {}
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.finished = threading.Event()
+
+    def to_dict(self):
+        """
+        ジョブの状態をjsonとして返すための辞書を作成する
+        """
+        # stagesは実行中のワーカースレッドがキーを追加するため、走査する前に複製する
+        # (dict()による複製はGILを保持したまま一度に行われ、途中で変更されない)
+        stages = dict(self.stages)
+        return {
+            "id": self.id,
+            "name": self.name,
+            "state": self.state,
+            "error": self.error,
+            "queuedAt": format_timestamp(self.queued_at),
+            "startedAt": format_timestamp(self.started_at),
+            "finishedAt": format_timestamp(self.finished_at),
+            "stages": {k: round(v, 3) for k, v in stages.items()},
+            # キューで待った秒数と実行にかかった秒数
+            "queueSeconds": elapsed_seconds(self.queued_at, self.started_at),
+            "runSeconds": elapsed_seconds(self.started_at, self.finished_at),
+        }
+
+
+def format_timestamp(timestamp):
+    """
+    UNIX時間をstatusと同じ形式の文字列に変換する関数。Noneの場合はNoneを返す
+    """
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp).strftime(
+        '%Y/%m/%d %H:%M:%S')
+
+
+def elapsed_seconds(start, end):
+    """
+    2つのUNIX時間の差(秒)を返す関数。どちらかがNoneの場合はNoneを返す
+    """
+    if start is None or end is None:
+        return None
+    return round(end - start, 3)
 
 
-class Thread(threading.Thread):
+class JobScheduler:
     """
-    スレッドを処理するためのクラス
+    上限付きのキューと固定数のワーカースレッドでジョブを実行するクラス
 
     Attributes:
-        id (str): スレッドID
-        input (any): スレッドで処理する入力データ
-        output (any): スレッドで生成される出力データ
+        queue (Queue): 実行待ちのジョブ
+        jobs (OrderedDict): ジョブIDをキーとした全ジョブ
+        workers (list): ワーカースレッド
     """
 
-    def __init__(self, id, input, output, *args, **kwargs):
+    def __init__(self, workers, queue_size, history):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.jobs = collections.OrderedDict()
+        self.history = history
+        self.workers = [Worker(self, i + 1) for i in range(workers)]
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        ワーカースレッドを開始する
+        """
+        for worker in self.workers:
+            if not worker.is_alive():
+                worker.start()
+
+    def submit(self, job):
         """
-        コンストラクタ。スレッドのID、入力、出力を初期化
+        ジョブをキューに追加する。キューが一杯の場合はqueue.Fullを送出する
 
         Args:
-            id (str): スレッドID
-            input (any): 入力データ
-            output (any): 出力データ
+            job (Job): 追加するジョブ
+        """
+        self.queue.put_nowait(job)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.prune()
+
+    def get(self, id):
+        """
+        ジョブIDからジョブを取得する。存在しない場合はNoneを返す
         """
-        super().__init__(*args, **kwargs)
+        with self.lock:
+            return self.jobs.get(id)
+
+    def prune(self):
+        """
+        完了済みのジョブがhistoryを超えた場合、古いものから削除する
+        """
+        finished = [id for id, job in self.jobs.items()
+                    if job.state in ("done", "failed")]
+        for id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[id]
+
+
+class Worker(threading.Thread):
+    """
+    キューからジョブを取り出してExcel出力処理を行うワーカースレッド
+
+    Attributes:
+        scheduler (JobScheduler): ジョブを取り出すスケジューラ
+        id (int): ワーカーID
+    """
+
+    def __init__(self, scheduler, id, *args, **kwargs):
+        super().__init__(*args, daemon=True, **kwargs)
+        self.scheduler = scheduler
         self.id = id
-        self.input = input
-        self.output = output
 
     def run(self):
         """
-        スレッドが実行するメソッド。Excel出力処理を実施
+        スレッドが実行するメソッド。キューのジョブを順にExcel出力処理する
         """
-        # スレッドが開始したことを表示
-        print(f"Thread ID: {self.id} has started.")
+        print(f"Worker ID: {self.id} has started.")
+        while True:
+            job = self.scheduler.queue.get()
+            self.process(job)
+            self.scheduler.queue.task_done()
+
+    def process(self, job):
+        """
+        1件のジョブを実行し、状態と所要時間を記録する
+
+        Args:
+            job (Job): 実行するジョブ
+        """
+        print(f"Worker ID: {self.id} Job ID: {job.id} ({job.name}) "
+              "has started.")
+        job.state = "running"
+        job.started_at = time.time()
 
         # 処理開始時間を取得・表示
         now = datetime.datetime.now()
         print("output_to_excel START! " + now.strftime('%Y年%m月%d日%H:%M:%S'))
 
         # Excel出力関数を呼び出し
-        output_to_excel(self.input, self.output)
+        try:
+            output_to_excel(job.input, job.output, job)
+            job.state = "done"
+        except Exception as e:
+            print(sys.exc_info())
+            job.state = "failed"
+            job.error = repr(e)
+        finally:
+            # 処理が終わった入力データは保持しない
+            if hasattr(job.input, "close"):
+                job.input.close()
+            job.input = None
+            job.finished_at = time.time()
+            job.finished.set()
 
         # 処理終了時間を取得・表示
         now = datetime.datetime.now()
         print("output_to_excel DONE!  " + now.strftime('%Y年%m月%d日%H:%M:%S'))
 
-        # スレッドが終了したことを表示
-        print(f"Thread ID: {self.id} has finished. ")
+        print(f"Worker ID: {self.id} Job ID: {job.id} has {job.state}.")
+
 
+scheduler = JobScheduler(
+    formatter_workers, formatter_queue_size, formatter_job_history)
+# レポート作成用のプロセスプール(FORMATTER_EXECUTORがprocessの場合のみ、起動時に作成)
+report_executor = None
+# Minioへのアップロードに使うMinioUploader(起動時に作成)
+uploader = None
 
-def output_to_excel(input: str, output: str):
+
+def output_to_excel(input: str, output: str, job=None):
     """
     json形式の入力データをもとに、エクセルファイルを出力する関数。
     出力されたファイルのパーミッションは644とする。
+    FORMATTER_PERSISTがfalseの場合はローカルにファイルを保存せず、
+    メモリ上(サイズが大きい場合は一時ファイル)に作成してMinioへ直接アップロードする。
 
     Args:
-        input (str): json形式の文字列。
+        input (str or dict or file): json形式の文字列、パース済みのjson、
+            またはjsonを読み出すファイルオブジェクト(itemsを1件ずつパースする)。
         output (str): 出力先のファイルパス（パスとファイル名を含む）。
+        job (Job): 処理段階ごとの所要時間を記録するジョブ。省略可。
     """
+    stages = job.stages if job is not None else None
+    started = time.perf_counter()
+
+    # 入力がファイルならば、itemsを1件ずつ読み出すjsonに変換
+    streamed = hasattr(input, "read")
+    if streamed:
+        # jsonファイルの名前を設定して、受け取ったjsonをそのまま保存
+        if formatter_persist:
+            with open(output.replace(".xlsx", ".json"), 'wb') as f:
+                shutil.copyfileobj(input, f)
+            input.seek(0)
+        input = stream_json(input)
 
     # 入力が文字列形式ならば、jsonに変換
     if isinstance(input, str):
-        input = json.loads(input)
+        input = parse_json(input)
+
+    # jsonファイルの名前を設定して保存(ストリーミングの場合と同じくjsonとして保存する)
+    if formatter_persist and not streamed:
+        jsonfilename = output.replace(".xlsx", ".json")
+        with open(jsonfilename, 'wb') as f:
+            f.write(dump_json(input))
+    record_stage(stages, "parse", started)
+
+    # ローカルに保存しない場合はメモリ上のバッファに書き込む
+    if formatter_persist:
+        target = output
+    else:
+        target = tempfile.SpooledTemporaryFile(
+            max_size=formatter_spool_max_size)
+
+    try:
+        # レポートを作成。プロセスプールを使う場合、件数が少なければ全体を1プロセスで、
+        # 多ければ展開処理を分割して複数プロセスで実行する
+        if report_executor is None:
+            build_report(input, target, stages)
+        elif not isinstance(input["items"], list) or \
+                len(input["items"]) > formatter_chunk_items:
+            build_report(input, target, stages, report_executor)
+        elif formatter_persist:
+            result = report_executor.submit(
+                build_report, input, target).result()
+            if stages is not None:
+                stages.update(result)
+        else:
+            data, result = report_executor.submit(
+                build_report_bytes, input).result()
+            target.write(data)
+            if stages is not None:
+                stages.update(result)
+
+        # ファイルをMinioにアップロード
+        started = time.perf_counter()
+        if formatter_persist:
+            minio_upload(output)
+        else:
+            minio_upload(output, target)
+        record_stage(stages, "upload", started)
+    finally:
+        if not formatter_persist:
+            target.close()
+    return
 
-    # jsonファイルの名前を設定して保存
-    jsonfilename = output.replace(".xlsx", ".json")
-    f = open(jsonfilename, 'w')
-    f.write(str(input))
-    f.close()
 
-    df = pandas.DataFrame()
-    kind_num = 0
+def build_report_bytes(input):
+    """
+    入力データからエクセルファイルを作成し、その内容をbytesで返す関数。
+    ローカルに保存しない場合に、プロセスプールで実行するために用いる。
+
+    Args:
+        input (dict): json形式の入力データ
+
+    Returns:
+        data (bytes): エクセルファイルの内容
+        stages (dict): 処理段階ごとの所要時間(秒)
+    """
+    with tempfile.SpooledTemporaryFile(
+            max_size=formatter_spool_max_size) as buffer:
+        stages = build_report(input, buffer)
+        buffer.seek(0)
+        return buffer.read(), stages
+
+
+def build_report(input, output, stages=None, executor=None):
+    """
+    入力データからエクセルファイルを作成する関数。
+    プロセスプールでも実行できるよう、入力と出力先のみを受け取り所要時間を返す。
+
+    Args:
+        input (dict): json形式の入力データ
+        output (str or file): 出力先のファイルパス（パスとファイル名を含む）、
+            またはファイルオブジェクト
+        stages (dict): 処理段階ごとの所要時間の記録先。省略時は新たに作成
+        executor (Executor): 指定した場合、アイテムの展開をこのプールで分割実行する
+
+    Returns:
+        stages (dict): 処理段階ごとの所要時間(秒)
+    """
+    if stages is None:
+        stages = {}
+    started = time.perf_counter()
 
     # jsonから必要な情報(kind, apiversion)を取得
     kind = input["kind"].replace("List", "")
     apiversion = input["apiVersion"]
-
-    # アイテムごとにデータフレームを作成・マージ
-    for item in input["items"]:
-        root_df = df
-        df = make_list(item, kind, apiversion)
-        kind_num += 1
-        if kind_num >= 2:
-            df = df_merge(root_df, df, kind_num, kind)
+    items = input["items"]
+
+    # アイテムごとに行バッファを作成・マージ
+    # (itemsがストリームの場合、アイテムを取り出す時間はparseとして記録する)
+    table = MergeTable(kind)
+    if executor is None:
+        for item in items:
+            started = record_stage(stages, "parse", started)
+            rows = flatten_item(item, kind, apiversion)
+            started = record_stage(stages, "flatten", started)
+            table.merge(*rows)
+            started = record_stage(stages, "merge", started)
+    else:
+        # 展開は分割して並列に行い、マージはアイテムの順序どおりに行う
+        # 実行中の分割数をプロセス数の2倍までに制限し、itemsを一度にすべて読み出さない
+        limit = (formatter_processes or cpu_quota()) * 2
+        pending = collections.deque()
+        chunks = iter_chunks(items, formatter_chunk_items)
+        while True:
+            for chunk in itertools.islice(chunks, limit - len(pending)):
+                pending.append(executor.submit(
+                    flatten_items, chunk, kind, apiversion))
+            started = record_stage(stages, "parse", started)
+            if not pending:
+                break
+            chunk_rows = pending.popleft().result()
+            started = record_stage(stages, "flatten", started)
+            for rows in chunk_rows:
+                table.merge(*rows)
+            started = record_stage(stages, "merge", started)
 
     # 出力先に同名のファイルが存在する場合は書き込みをしない
-    if not os.path.isfile(output):
-        df = df.reset_index(drop=True)
-
-        # Excelの最初のセルを初期化
-        _, max_col = df.shape
-        df = df.style.set_properties(
-            **{"background-color": "#ffffd1"}).set_properties(
-            **{"background-color": "#dddddd"},
-            subset=pandas.IndexSlice[:, "key1":"key" + str(max_col - kind_num)])
-
+    if not isinstance(output, str) or not os.path.isfile(output):
         # Excelへの書き込み開始時刻をprint
         now = datetime.datetime.now()
-        print("df.to_excel START! " + now.strftime('%Y年%m月%d日%H:%M:%S'))
+        print("write_excel START! " + now.strftime('%Y年%m月%d日%H:%M:%S'))
 
-        df.to_excel(output)
+        write_excel(table, output)
 
         # Excelへの書き込み終了時刻をprint
         now = datetime.datetime.now()
-        print("df.to_excel STOP! " + now.strftime('%Y年%m月%d日%H:%M:%S'))
+        print("write_excel STOP! " + now.strftime('%Y年%m月%d日%H:%M:%S'))
 
         # ファイルのパーミッションを設定
-        os.chmod(output, 0o644)
+        if isinstance(output, str):
+            os.chmod(output, 0o644)
     else:
         print("出力先にファイルが存在します。")
+    record_stage(stages, "write", started)
+    return stages
 
-    # ファイルをMinioにアップロード
-    minio_upload(output)
-    return
 
+def iter_chunks(items, size):
+    """
+    itemsをsize件ずつのリストに分割して返すジェネレータ
 
-def minio_upload(output):
+    Args:
+        items (iterable): 分割するアイテム(リストまたはジェネレータ)
+        size (int): 1つのリストの件数
     """
-    指定されたファイルをMinioにアップロードする関数。
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def stream_json(f):
+    """
+    jsonのファイルから、kind, apiVersionとitemsを1件ずつ返すジェネレータを持つ辞書を作成する。
+    リスト全体をパースせず、ピーク時のメモリを最大のアイテム1件分に抑える。
+    ijsonがインストールされていない場合や旧形式のjson文字列の場合は全体をパースする。
 
     Args:
-        output (str): アップロードするファイルのパス（パスとファイル名を含む）。
+        f (file): jsonを読み出すファイルオブジェクト
+
+    Returns:
+        dict: kind, apiVersion, itemsを持つ辞書
     """
-    # 環境変数(env)からMinioの設定情報を取得
-    minio_backet = os.environ.get('MINIO_BACKET')
-    minio_endpoint_url = os.environ.get('MINIO_ENDPOINT_URL')
-    minio_access_key_id = os.environ.get('MINIO_ACCESS_KEY_ID')
-    minio_secret_access_key = os.environ.get('MINIO_SECRET_ACCESS_KEY')
-
-    # boto3を用いてS3クライアントを作成（ここではMinioをS3として扱う）
-    s3 = boto3.client(
-        's3',
-        use_ssl=False,
-        endpoint_url=minio_endpoint_url,
-        aws_access_key_id=minio_access_key_id,
-        aws_secret_access_key=minio_secret_access_key)
-
-    # 既存のバケットをリストアップ
-    buckets = s3.list_buckets()["Buckets"]
-
-    # 指定されたバケットが存在するかどうかを確認
-    bucket_flag = False
-    if len(buckets) > 0:
-        for bucket in buckets:
-            bucket_name = bucket["Name"]
-            if bucket_name == minio_backet:
-                bucket_flag = True
+    # 旧形式(json文字列として再エンコードされたjson)の場合は全体をパースする
+    head = f.read(64).lstrip()
+    f.seek(0)
+    if ijson is None or head.startswith(b'"'):
+        input = parse_json(f.read())
+        if isinstance(input, str):
+            input = parse_json(input)
+        return input
+
+    # トップレベルのkind, apiVersionを取得(通常はitemsより前にあるため、すぐに見つかる)
+    header = {}
+    for prefix, event, value in ijson.parse(f):
+        if prefix in ("kind", "apiVersion") and event == "string":
+            header[prefix] = value
+            if len(header) == 2:
                 break
+    f.seek(0)
+    if len(header) < 2:
+        raise ValueError("kind or apiVersion is not found")
+
+    header["items"] = ijson.items(f, "items.item", use_float=True)
+    return header
+
+
+def parse_json(data):
+    """
+    jsonをパースする関数。orjsonがインストールされている場合はorjsonを使う
+
+    Args:
+        data (bytes or str): json形式のデータ
+
+    Returns:
+        any: パースした結果
+
+    Raises:
+        ValueError: jsonとして不正な場合(json.JSONDecodeErrorはValueErrorのサブクラス)
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dump_json(data):
+    """
+    jsonをbytesに変換する関数。orjsonがインストールされている場合はorjsonを使う
+
+    Args:
+        data (any): jsonに変換するデータ
+
+    Returns:
+        bytes: json形式のデータ
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode()
+
+
+class BodyTooLargeError(Exception):
+    """
+    展開後のリクエストのbodyが上限(FORMATTER_MAX_BODY_SIZE)を超えた場合の例外
+    """
+
+
+class LimitedWriter:
+    """
+    書き込んだサイズの合計が上限を超えた場合にBodyTooLargeErrorを送出するファイルオブジェクト
+
+    Attributes:
+        output (file): 書き込み先のファイルオブジェクト
+        max_size (int): 書き込める最大サイズ(byte)
+        size (int): 書き込んだサイズの合計(byte)
+    """
+
+    def __init__(self, output, max_size):
+        self.output = output
+        self.max_size = max_size
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise BodyTooLargeError(
+                "request body exceeds " + str(self.max_size) + " bytes")
+        self.output.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class ZlibWriter:
+    """
+    gzip, deflateのbodyを一定のサイズずつ展開して書き込むファイルオブジェクト
+    (小さなbodyが展開後に巨大になる場合も、一度に展開するのはchunk_sizeまでとする)
+    """
+
+    def __init__(self, output, wbits, chunk_size=64 * 1024):
+        self.output = output
+        self.decoder = zlib.decompressobj(wbits)
+        self.chunk_size = chunk_size
+
+    def write(self, data):
+        while True:
+            out = self.decoder.decompress(data, self.chunk_size)
+            self.output.write(out)
+            data = self.decoder.unconsumed_tail
+            # 入力を使い切り、展開済みのデータも残っていなければ終了
+            if not data and len(out) < self.chunk_size:
+                return
+
+    def flush(self):
+        self.output.write(self.decoder.flush())
+
+
+def body_writer(content_encoding, output, max_size):
+    """
+    リクエストのContent-Encodingに応じて、bodyを逐次展開しながら出力先に書き込む
+    ファイルオブジェクトを返す関数。展開後のサイズがmax_sizeを超えた場合は
+    書き込み時にBodyTooLargeErrorを送出する
+
+    Args:
+        content_encoding (str): リクエストのContent-Encoding
+        output (file): 展開したbodyの書き込み先
+        max_size (int): 展開後のbodyの最大サイズ(byte)
+
+    Returns:
+        object: write(bytes), flush()を持つオブジェクト
+
+    Raises:
+        ValueError: 対応していないContent-Encodingの場合
+    """
+    limited = LimitedWriter(output, max_size)
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding == "identity":
+        return limited
+    if encoding in ("gzip", "x-gzip"):
+        # wbits=31でgzip形式を展開する
+        return ZlibWriter(limited, 31)
+    if encoding == "deflate":
+        return ZlibWriter(limited, zlib.MAX_WBITS)
+    if encoding == "zstd" and zstandard is not None:
+        # stream_writerは展開した内容を一定のサイズずつlimitedに書き込む
+        return zstandard.ZstdDecompressor().stream_writer(
+            limited, closefd=False)
+    raise ValueError("unsupported content encoding: " + encoding)
+
+
+def record_stage(stages, stage, started):
+    """
+    処理段階の所要時間を加算する関数。stagesがNoneの場合は記録しない
+
+    Args:
+        stages (dict): 記録先の辞書
+        stage (str): 処理段階の名前(parse, flatten, merge, write, upload)
+        started (float): 処理段階の開始時刻(time.perf_counter)
+
+    Returns:
+        float: 現在時刻(次の処理段階の開始時刻)
+    """
+    now = time.perf_counter()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + now - started
+    return now
+
+
+def cpu_quota():
+    """
+    コンテナに割り当てられたCPU数を返す関数。
+    cgroupのCPU quotaが設定されていない場合はos.cpu_count()を返す
+    """
+    cpus = os.cpu_count() or 1
+    try:
+        # cgroup v2
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                quota = f.read().strip()
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = f.read().strip()
+        except OSError:
+            return cpus
+    if quota in ("max", "-1"):
+        return cpus
+    return max(1, min(cpus, math.ceil(int(quota) / int(period))))
+
+
+def create_report_executor():
+    """
+    FORMATTER_EXECUTORがprocessの場合、レポート作成用のプロセスプールを作成する関数
+
+    Returns:
+        ProcessPoolExecutor: プロセスプール。threadの場合はNone
+    """
+    if formatter_executor != "process":
+        return None
+    processes = formatter_processes or cpu_quota()
+    print(f"Report executor: process pool with {processes} processes.")
+    # ワーカースレッドが動作しているプロセスをforkしないようspawnを使う
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("spawn"))
+
+
+def write_excel(table, output):
+    """
+    MergeTableの内容を1行ずつエクセルファイルへ書き出す関数。
+    openpyxlのwrite-onlyモードを使い、ワークブック全体をメモリに保持しない。
+    セルの書式はkey列(灰色)、kind列(黄色)、見出しの共通の書式を使い回す。
+
+    Args:
+        table (MergeTable): 書き出す結合結果
+        output (str or file): 出力先のファイルパス、またはファイルオブジェクト
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+
+    # 見出し行: 1列目はインデックス列のため空白
+    ws.append([None] + [
+        excel_cell(ws, column, EXCEL_HEADER_STYLE)
+        for column in table.columns()])
+
+    # データ行: 1列目にインデックス、key列は灰色、kind列は黄色で塗りつぶす
+    key_count = table.key_count
+    for index, row in enumerate(table.iter_rows()):
+        cells = [excel_cell(ws, index, EXCEL_HEADER_STYLE)]
+        for col, value in enumerate(row):
+            if col < key_count:
+                cells.append(excel_cell(ws, value, EXCEL_KEY_STYLE))
+            else:
+                cells.append(excel_cell(ws, value, EXCEL_VALUE_STYLE))
+        ws.append(cells)
+
+    wb.save(output)
+
+
+def excel_cell(ws, value, style):
+    """
+    書式を設定したwrite-onlyモード用のセルを作成する関数
+
+    Args:
+        ws (WriteOnlyWorksheet): 書き込み先のシート
+        value (any): セルの値。空文字は空セル、辞書やリストは文字列として書き込む
+        style (dict): セルに設定する書式
+
+    Returns:
+        WriteOnlyCell: 作成したセル
+    """
+    if isinstance(value, str) and value == "":
+        value = None
+    elif isinstance(value, (dict, list)):
+        value = str(value)
+    cell = WriteOnlyCell(ws, value=value)
+    for name, obj in style.items():
+        setattr(cell, name, obj)
+    return cell
+
 
-    # 指定されたバケットが存在しない場合、新規作成
-    if bucket_flag is False:
-        s3.create_bucket(Bucket=minio_backet)
+class MinioUploader:
+    """
+    Minioへファイルをアップロードするクラス。
+    S3クライアントは起動時に一度だけ作成してコネクションプールを再利用し、
+    バケットの存在確認の結果もキャッシュする。
+
+    Attributes:
+        bucket (str): アップロード先のバケット名
+        s3 (S3.Client): boto3のS3クライアント
+        transfer_config (TransferConfig): マルチパートアップロードの設定
+        bucket_checked (bool): バケットの存在を確認済みかどうか
+    """
+
+    def __init__(
+            self,
+            bucket,
+            endpoint_url,
+            access_key_id,
+            secret_access_key,
+            max_pool_connections=10,
+            multipart_threshold=8 * 1024 * 1024,
+            multipart_chunksize=8 * 1024 * 1024,
+            max_concurrency=4):
+        self.bucket = bucket
+        # boto3を用いてS3クライアントを作成（ここではMinioをS3として扱う）
+        self.s3 = boto3.client(
+            's3',
+            use_ssl=False,
+            endpoint_url=endpoint_url,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key,
+            config=botocore.config.Config(
+                max_pool_connections=max_pool_connections))
+        self.transfer_config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency)
+        self.bucket_checked = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """
+        環境変数(env)からMinioの設定情報を取得してMinioUploaderを作成する
+
+        MINIO_MAX_POOL_CONNECTIONS: コネクションプールの最大接続数
+        MINIO_MULTIPART_THRESHOLD: マルチパートアップロードを行うファイルサイズ(byte)
+        MINIO_MULTIPART_CHUNKSIZE: マルチパートアップロードの1パートのサイズ(byte)
+        MINIO_MAX_CONCURRENCY: マルチパートアップロードの並列数
+        """
+        return cls(
+            os.environ.get('MINIO_BACKET'),
+            os.environ.get('MINIO_ENDPOINT_URL'),
+            os.environ.get('MINIO_ACCESS_KEY_ID'),
+            os.environ.get('MINIO_SECRET_ACCESS_KEY'),
+            max_pool_connections=int(
+                os.environ.get('MINIO_MAX_POOL_CONNECTIONS', '10')),
+            multipart_threshold=int(
+                os.environ.get('MINIO_MULTIPART_THRESHOLD', '8388608')),
+            multipart_chunksize=int(
+                os.environ.get('MINIO_MULTIPART_CHUNKSIZE', '8388608')),
+            max_concurrency=int(
+                os.environ.get('MINIO_MAX_CONCURRENCY', '4')))
+
+    def ensure_bucket(self):
+        """
+        バケットが存在しない場合は新規作成する。確認結果はキャッシュする
+        """
+        if self.bucket_checked:
+            return
+        with self.lock:
+            if self.bucket_checked:
+                return
+            try:
+                self.s3.head_bucket(Bucket=self.bucket)
+            except botocore.exceptions.ClientError as e:
+                # 指定されたバケットが存在しない場合、新規作成
+                if e.response["Error"]["Code"] not in ("404", "NoSuchBucket"):
+                    raise
+                self.s3.create_bucket(Bucket=self.bucket)
+            self.bucket_checked = True
+
+    def upload(self, output, body=None):
+        """
+        ファイルをバケットにアップロードする
 
-    # ファイルをバケットにアップロード
-    filename = os.path.basename(output)
-    s3.upload_file(output, minio_backet, filename)
+        Args:
+            output (str): アップロードするファイルのパス（パスとファイル名を含む）。
+            body (file): 指定した場合、ファイルではなくこのファイルオブジェクトの内容を
+                outputのファイル名でアップロードする
+        """
+        self.ensure_bucket()
+        filename = os.path.basename(output)
+        try:
+            if body is None:
+                self.s3.upload_file(
+                    output, self.bucket, filename, Config=self.transfer_config)
+            else:
+                body.seek(0)
+                self.s3.upload_fileobj(
+                    body, self.bucket, filename, Config=self.transfer_config)
+        except Exception:
+            # バケットが削除された場合に備え、次回は存在確認からやり直す
+            self.bucket_checked = False
+            raise
+
+
+def minio_upload(output, body=None):
+    """
+    指定されたファイルをMinioにアップロードする関数。
+
+    Args:
+        output (str): アップロードするファイルのパス（パスとファイル名を含む）。
+        body (file): 指定した場合、このファイルオブジェクトの内容をアップロードする
+    """
+    global uploader
+    if uploader is None:
+        uploader = MinioUploader.from_env()
+    uploader.upload(output, body)
 
 
 def make_list(item, kind, apiversion):
     """
     引数で渡された情報からpandasのDataFrameを作成する関数
 
+    itemを一度だけ走査して行バッファ(keyのパスとvalueの組)に展開し、
+    DataFrameは最後に一度だけ生成する
+
     Args:
         item (dict): 処理対象のアイテム
         kind (str): アイテムのk8s kind(種類)を示す文字列
         apiversion (str): アイテムのk8s APIversionを示す文字列
     """
-    global current_row_num, key_num, kind_num
+    table = MergeTable(kind)
+    table.merge(*flatten_item(item, kind, apiversion))
+    return table.to_dataframe()
 
-    # key_num: 次に新規に追加すべきkeyの番号。既にkey1, key2があればkey_numは3
-    key_num = 1
-    # current_key_num: 現在のkeyが何階層にあるかを示す(初期は0階層。再帰呼び出しのたびに1階層深くなる)
-    current_key_num = 0
-    # kind_num 現在何番目のkindかを表す(初期値は1番目のkindを示す)
-    kind_num = 1
-    # current_row_num: Excelの現在の行番号
-    current_row_num = 1
 
-    df = pandas.DataFrame()
+def flatten_item(item, kind, apiversion):
+    """
+    アイテムを行バッファに展開する関数
+
+    Args:
+        item (dict): 処理対象のアイテム
+        kind (str): アイテムのk8s kind(種類)を示す文字列
+        apiversion (str): アイテムのk8s APIversionを示す文字列
+
+    Returns:
+        rows (list): (keyのパスのtuple, value)のリスト
+        key_count (int): key列の数(key1~keyNのN)
+    """
+    rows = []
+    key_count = 0
     # item内の各キーと値に対して処理を行う
     for k, v_dict in item.items():
         # CRD対応: 一番浅い階層でkeyがapiVersionまたはkindの場合、重複排除のためループをスキップする
-        if current_key_num == 0 and (k == "apiVersion" or k == "kind"):
+        if k == "apiVersion" or k == "kind":
             continue
 
-        # 最初のループでのみ実施されるデータフレームの初期化処理
-        if current_row_num == 1:
-            # 初期のDataFrameを作成
-            df = pandas.DataFrame(
-                columns=[
-                    'key' + str(key_num),
-                    kind + str(kind_num)])
-            key_num += 1
-            # kind情報をDataFrameに追加
-            df, key_num, current_row_num = analyze_nested_list(
-                df, "kind", kind, key_num, kind_num, current_row_num,
-                current_key_num + 1, -1)
-            # apiversion情報をDataFrameに追加
-            df, key_num, current_row_num = analyze_nested_list(
-                df, "apiVersion", apiversion, key_num, kind_num,
-                current_row_num, current_key_num + 1, -1)
+        # 最初のループでのみkind, apiversion情報を追加
+        if not rows:
+            key_count = max(
+                analyze_nested_list(rows, (), "kind", kind, -1),
+                analyze_nested_list(rows, (), "apiVersion", apiversion, -1))
 
         # 毎ループの処理
-        df, key_num, current_row_num = analyze_nested_list(
-            df, k, v_dict, key_num, kind_num, current_row_num,
-            current_key_num + 1, -1)
+        key_count = max(
+            key_count, analyze_nested_list(rows, (), k, v_dict, -1))
 
-    return df
+    return rows, key_count
 
 
-def analyze_nested_list(
-        df,
-        k,
-        v_dict,
-        key_num,
-        kind_num,
-        current_row_num,
-        current_key_num,
-        duplication_num):
+def flatten_items(items, kind, apiversion):
     """
-    ネストされた辞書やリストを解析して、pandasのDataFrameに情報を追加する
+    複数のアイテムを行バッファに展開する関数(プロセスプールでの分割実行用)
 
     Args:
-        df (DataFrame): 情報を追加する対象のDataFrame
+        items (list): 処理対象のアイテムのリスト
+        kind (str): アイテムのk8s kind(種類)を示す文字列
+        apiversion (str): アイテムのk8s APIversionを示す文字列
+
+    Returns:
+        list: アイテムごとの(rows, key_count)のリスト
+    """
+    return [flatten_item(item, kind, apiversion) for item in items]
+
+
+def analyze_nested_list(rows, path, k, v_dict, duplication_num):
+    """
+    ネストされた辞書やリストを解析して、行バッファに情報を追加する
+
+    Args:
+        rows (list): 情報を追加する対象の行バッファ
+        path (tuple): 親の階層までのkeyのパス
         k (str): 辞書のキー
         v_dict (various): 辞書の値。辞書またはリストであることが多い
-        key_num (int): 新しいキーを追加する位置
-        kind_num (int): 現在何番目のkindか
-        current_row_num (int): DataFrameの現在の行数
-        current_key_num (int): 現在処理しているキーの階層
         duplication_num (int): 重複するキーがある場合のカウンタ。無い場合は-1
 
     Returns:
-        df (DataFrame): 更新されたDataFrame
-        key_num (int): 更新された新しいキーを追加する位置
-        current_row_num (int): 更新されたDataFrameの現在の行数
-    """
-    # 列を追加するか判定。key_numとcurrent_key_numが一致したら新たな列を追加
-    if key_num == current_key_num:
-        # 列を追加。既存の行数に合わせて空のデータを作成
-        # current_row_num分の配列を作成 (current_row_num=5なら["","","","",""]を作成)
-        New_Column = [""] * (current_row_num - 1)
-        df.insert(
-            loc=current_key_num - 1,
-            column='key' + str(key_num),
-            value=New_Column)
-        # key_numの加算
-        key_num += 1
+        max_key_num (int): 処理したキーの最も深い階層
+    """
+    # キー名を作成。キー名が重複している場合、"annotations(2)"のように表現
+    if duplication_num == -1:
+        key_path = path + (k,)
+    else:
+        key_path = path + (k + "(" + str(duplication_num) + ")",)
+    max_key_num = len(key_path)
 
     # 値が文字列、または空の辞書の場合
     if (not isinstance(v_dict, dict) and not isinstance(v_dict, list)) or (
-            isinstance(v_dict, dict) and json.dumps(v_dict).startswith('{}')):
-        # 新しい行を作成
-        New_Column = [""] * (key_num - 1 + kind_num)
-
-        # key, valueをセルへ挿入 ["","",""] -> ["","annotations","testtesttest"]
-        # キー名をDataFrameに追加。キー名が重複している場合、"annotations(2)"のように表現
-        if duplication_num == -1:
-            New_Column[current_key_num - 1] = k
-        else:
-            New_Column[current_key_num - 1] = k + \
-                "(" + str(duplication_num) + ")"
-
+            isinstance(v_dict, dict) and not v_dict):
         # 値が無い(None)場合、valueに"null"として追加。値がある場合はその値を追加
-        if isinstance(v_dict, type(None)):
-            v2 = "null"
-        else:
-            v2 = v_dict
-
-        # 値をDataFrameに追加
-        New_Column[key_num - 1 + kind_num - 1] = v2
-        # 新しい行をDataFrameに追加
-        s = pandas.Series(New_Column, index=df.columns)
-        df = pandas.concat([df, s.to_frame().T], ignore_index=True)
-        # 行数を更新
-        current_row_num += 1
+        if v_dict is None:
+            v_dict = "null"
+        rows.append((key_path, v_dict))
 
     # 値が辞書型("{"で始まる)の場合
     elif isinstance(v_dict, dict):
-        # この中の処理では、
         # {}のkey, valueの分解のために自身を再帰呼び出し
-        # keyをセルに挿入
         for nested_k, nested_v_dict in v_dict.items():
-            past_row_num = current_row_num
-            # 再帰的にこの関数を呼び出し、key, valueを処理
-            df, key_num, current_row_num = analyze_nested_list(
-                df, nested_k, nested_v_dict, key_num, kind_num, current_row_num,
-                current_key_num + 1, -1)
-
-            # 重複している既存のキーを追加
-            for i in range(current_row_num - past_row_num):
-                # metadata などの前のkeyをセルに挿入する処理
-                if duplication_num == -1:
-                    df.iat[current_row_num - 2 - i, current_key_num - 1] = k
-                else:
-                    df.iat[current_row_num - 2 - i, current_key_num -
-                           1] = k + "(" + str(duplication_num) + ")"
+            max_key_num = max(max_key_num, analyze_nested_list(
+                rows, key_path, nested_k, nested_v_dict, -1))
 
     # 値がリスト型("["で始まる)の場合
-    elif isinstance(v_dict, list):
+    else:
         # ここでのnumはリストのforループ回数に応じてカウントし、duplication_numの代わりに扱う
         # (再帰呼び出しした際にannotation(3)のようにkeyを挿入するため)
         num = 1
-        # リストの値を取り出して再帰呼び出しやセルへ挿入を行う
         for v_dict2 in v_dict:
-            if isinstance(v_dict2, str):
+            if not isinstance(v_dict2, dict):
                 # 値が文字列の場合: valueがargの場合の特別対応
                 # (key: valueではなく、strだけがlistの中に入っているケース)
-                if duplication_num == -1:
-                    df, key_num, current_row_num = analyze_nested_list(
-                        df, k, str(v_dict), key_num, kind_num, current_row_num,
-                        current_key_num, -1)
-                else:
-                    df, key_num, current_row_num = analyze_nested_list(
-                        df, k, str(v_dict), key_num, kind_num, current_row_num,
-                        current_key_num, duplication_num)
+                rows.append((key_path, str(v_dict)))
                 break
 
-            else:
-                for nested_k, nested_v_dict in v_dict2.items():
-                    past_row_num = current_row_num
-                    # 再帰的にこの関数を呼び出し
-                    df, key_num, current_row_num = analyze_nested_list(
-                        df, nested_k, nested_v_dict, key_num, kind_num,
-                        current_row_num, current_key_num + 1, num)
-
-                    # 重複している既存のキーを追加
-                    for i in range(current_row_num - past_row_num):
-                        # metadata などの前のkeyをセルに挿入する処理
-                        if duplication_num == -1:
-                            df.iat[current_row_num - 2 -
-                                   i, current_key_num - 1] = k
-                        else:
-                            df.iat[current_row_num - 2 - i, current_key_num -
-                                   1] = k + "(" + str(duplication_num) + ")"
+            for nested_k, nested_v_dict in v_dict2.items():
+                max_key_num = max(max_key_num, analyze_nested_list(
+                    rows, key_path, nested_k, nested_v_dict, num))
             num += 1
-    else:
-        print("例外です。タイプは" + type(v_dict))
 
-    return df, key_num, current_row_num
+    return max_key_num
+
+
+class MergeRow:
+    """
+    MergeTableの1行を表すクラス(単方向連結リストのノード)
+
+    Attributes:
+        key_path (tuple): 行のkey列の値
+        values (dict): kindの番号をキーとした値
+        next (MergeRow): 次の行
+    """
+    __slots__ = ("key_path", "values", "next")
+
+    def __init__(self, key_path):
+        self.key_path = key_path
+        self.values = {}
+        self.next = None
+
+
+class MergeTable:
+    """
+    アイテムごとの行バッファをkey列のパスをもとに結合するクラス
+
+    keyのパスのprefixから、そのprefixを持つ最初の行と最後の行への索引を保持する。
+    完全一致は辞書の参照で、最長一致するprefixの挿入位置も走査せずに求める。
+    行は連結リストに挿入するため、DataFrameの分割・再結合は行わない。
+
+    Attributes:
+        kind (str): kind列の名前の接頭辞
+        key_count (int): key列の数
+        kind_count (int): kind列の数(結合したアイテムの数)
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.key_count = 0
+        self.kind_count = 0
+        self.head = None
+        self.first = {}
+        self.last = {}
+
+    @classmethod
+    def from_dataframe(cls, df, kind_count, kind):
+        """
+        make_list, df_mergeで作成されたDataFrameからMergeTableを作成する
+
+        Args:
+            df (DataFrame): key1~keyN, kind1~kindMからなるDataFrame
+            kind_count (int): dfのkind列の数
+            kind (str): kind列の名前の接頭辞
+        """
+        table = cls(kind)
+        _, max_col = df.shape
+        table.key_count = max_col - kind_count
+        table.kind_count = kind_count
+        for row in df.itertuples(index=False):
+            key_path = tuple(row[:table.key_count])
+            values = dict(enumerate(row[table.key_count:], 1))
+            table.append(key_path, values)
+        return table
+
+    def append(self, key_path, values):
+        """
+        行を末尾に追加する(最初のアイテムはそのままの順序で格納する)
+        """
+        node = MergeRow(key_path)
+        node.values = values
+        compare_value = match_key_path(key_path)
+        if self.head is None:
+            self.head = node
+        else:
+            self.last[()].next = node
+        for i in range(len(compare_value) + 1):
+            self.first.setdefault(compare_value[:i], node)
+            self.last[compare_value[:i]] = node
+
+    def insert(self, compare_value, match_count):
+        """
+        compare_value[:match_count]を持つ最後の行の次に行を挿入する
+        """
+        node = MergeRow(compare_value)
+        prev = self.last.get(compare_value[:match_count])
+        if prev is None:
+            node.next = self.head
+            self.head = node
+        else:
+            node.next = prev.next
+            prev.next = node
+
+        # 既存のprefixは、挿入位置の行が最後の行であった場合のみ更新
+        for i in range(match_count + 1):
+            if self.last.get(compare_value[:i]) is prev:
+                self.last[compare_value[:i]] = node
+        # 新しいprefixは挿入した行のみを指す
+        for i in range(match_count + 1, len(compare_value) + 1):
+            self.first[compare_value[:i]] = node
+            self.last[compare_value[:i]] = node
+        if () not in self.first:
+            self.first[()] = node
+        return node
+
+    def merge(self, rows, key_count):
+        """
+        アイテムの行バッファを新しいkind列として結合する
+        結合の際に、keyのパスでマッチしない行は新たに追加される
+
+        Args:
+            rows (list): (keyのパスのtuple, value)のリスト
+            key_count (int): rowsのkey列の数
+        """
+        self.key_count = max(self.key_count, key_count)
+        self.kind_count += 1
+        kind_num = self.kind_count
+
+        # 最初のアイテムはそのまま追加
+        if kind_num == 1:
+            for key_path, value in rows:
+                self.append(key_path, {kind_num: value})
+            return
+
+        for key_path, value in rows:
+            compare_value = match_key_path(key_path)
+            # 完全一致(compare_valueをprefixに持つ最初の行)の場合、その行に値を入力
+            node = self.first.get(compare_value)
+            if node is None:
+                # 一致しない場合、最長一致するprefixを持つ最後の行の次に挿入
+                match_count = len(compare_value) - 1
+                while match_count > 0 and \
+                        compare_value[:match_count] not in self.first:
+                    match_count -= 1
+                node = self.insert(compare_value, match_count)
+            node.values[kind_num] = value
+
+    def columns(self):
+        """
+        列名(key1~keyN, kind1~kindM)のリストを返す
+        """
+        return ['key' + str(i) for i in range(1, self.key_count + 1)] + \
+            [self.kind + str(i) for i in range(1, self.kind_count + 1)]
+
+    def iter_rows(self):
+        """
+        結合結果の各行(key列の値とkind列の値のリスト)を先頭から順に返す
+        """
+        node = self.head
+        while node is not None:
+            padding = [""] * (self.key_count - len(node.key_path))
+            values = [node.values.get(i, "")
+                      for i in range(1, self.kind_count + 1)]
+            yield list(node.key_path) + padding + values
+            node = node.next
+
+    def to_dataframe(self):
+        """
+        結合結果からDataFrameを一度に生成する
+
+        Returns:
+            DataFrame: key1~keyN, kind1~kindMからなるDataFrame
+        """
+        if self.head is None and self.key_count == 0:
+            return pandas.DataFrame()
+        return pandas.DataFrame(
+            list(self.iter_rows()), columns=self.columns(), dtype=object)
+
+
+def match_key_path(key_path):
+    """
+    比較に用いるkeyのパスを返す関数。空白のkey以降は比較に含めない
+
+    Args:
+        key_path (tuple): 行のkey列の値
+
+    Returns:
+        tuple: 先頭から空白でないkeyのみを取り出したパス
+    """
+    for i, k in enumerate(key_path):
+        if str(k) == "":
+            return tuple(key_path[:i])
+    return tuple(key_path)
 
 
 def df_merge(root_df, branch_df, kind_num, kind):
@@ -381,107 +1205,28 @@ def df_merge(root_df, branch_df, kind_num, kind):
     - pd.DataFrame
         結合後のDataFrame
     """
+    table = MergeTable.from_dataframe(root_df, kind_num - 1, kind)
 
-    # branch_dfの行(row)と列(col)の最大値を取得する
-    # ここで取得する列(col)はkey1~x + kind1の合計値 (マージされるbranch_dfのkindは常に1つだけ)
-    branch_max_row, branch_max_col = branch_df.shape
-    # keyの最大値を出す (kind1のcol分をデクリメント)
-    branch_key_num = branch_max_col - 1
-
-    # root_dfの行(row)と列(col)の最大値を取得する
-    root_max_row, root_max_col = root_df.shape
-    # keyの最大値を出す (kindのcol分をデクリメント)
-    root_key_num = root_max_col - kind_num + 1
-
-    # root_dfのkey数(root_key_num)とbranch_dfのkey数(branch_key_num)を比較して、branch_dfの方が大きければ、その分のkey列をroot_dfに追加(手順0)
-    if root_key_num < branch_key_num:
-        add_key_num = branch_key_num - root_key_num
-        for i in range(1, add_key_num + 1):
-            root_df.insert(root_key_num - 1 + i, 'key' +
-                           str(root_key_num + i), "")
-        # root_dfの行と列の最大値を取得する
-        root_max_row, root_max_col = root_df.shape
-
-    # kind n+1 の列を追加する(手順1)
-    root_df.insert(root_max_col, kind + str(kind_num), "")
-    kind_num = kind_num + 1
-
-    # root_dfの行と列の最大値を更新する
-    root_max_row, root_max_col = root_df.shape
-
-    # branch_dfの全行を取り出すループ処理
-    for branch_row in range(0, branch_max_row):
-        # 手順2
-        # branch_dfの一行目のkeyを読み込み、root_dfの全行と比較
-        # compare_value: branch_dfの特定の行のkeyをまとめて保持する配列
-        compare_value = []
-
-        # branch_dfの列ループ(key1 -> key8 -> kind1)
-        # 「branch_dfの一行目のkeyを読み込み」の部分
-        for branch_col in range(0, branch_key_num):
-            # 空白の場合は配列に値を格納しない
-            if str(branch_df.iat[branch_row, branch_col]) != "":
-                compare_value.append(branch_df.iat[branch_row, branch_col])
-            else:
-                break
+    # branch_dfのkindは常に1つだけ
+    branch_key_num = branch_df.shape[1] - 1
+    rows = [(tuple(row[:branch_key_num]), row[branch_key_num])
+            for row in branch_df.itertuples(index=False)]
+    table.merge(rows, branch_key_num)
+    return table.to_dataframe()
 
-        similar_key_row = -1
-        root_match_count = 0
-        # root_dfの全行と読み込んだbranch_dfのkeyを比較する処理
-        # root_dfの全行のループ処理
-        for root_row in range(0, root_max_row):
-            # root_df側で一致したkeyの行数を格納する配列
-            hit_flag = []
-            branch_match_count = 0
-            # 取り出した比較すべきすべての列が連続して一致していることを保持するフラグ
-            sequential_count = True
-            # root_dfの特定の行のkey(列)を取り出すループ処理
-            for root_col in range(0, len(compare_value)):
-                # root_df側で取り出したkeyとbranch_df側で取り出したkeyを比較する
-                if root_df.iat[root_row,
-                               root_col] == compare_value[root_col]:
-                    hit_flag.append(root_row)
-                    if sequential_count:
-                        branch_match_count += 1
-                else:
-                    hit_flag.append(str(-1))
-                    sequential_count = False
-
-            # 行の完全一致を示すフラグ
-            match_row = True
-            # 特定の行の全keyを調べても完全一致しない場合、または不一致のkeyが存在する場合
-            if hit_flag.count(root_row) != len(
-                    hit_flag) or str(-1) in hit_flag:
-                match_row = False
-
-                if branch_match_count >= root_match_count:
-                    similar_key_row = root_row
-                    root_match_count = branch_match_count
-            if match_row:
-                # 手順3: root_dfのkind2の当該行のkind2セルにbranch_dfのvalueを入力
-                root_df.iat[root_row, root_max_col -
-                            1] = branch_df.iat[branch_row, branch_max_col - 1]
-                break
 
-        # branch_dfの特定の行を取り出してroot_dfの全行と比較しても一致がない場合
-        if not match_row:
-            # 手順10
-            # 行を挿入する
-            similar_key_row += 1
-            df1 = root_df[0:similar_key_row].copy()
-            df2 = root_df[similar_key_row:]
-            padding = [""] * (root_max_col - len(compare_value))
-            df1.loc[similar_key_row] = compare_value + padding
-            root_df = pandas.concat([df1, df2])
-
-            # kindの値を挿入する
-            root_df.iat[similar_key_row, root_max_col -
-                        1] = branch_df.iat[branch_row, branch_max_col - 1]
-
-        # root_dfの行と列の最大値を更新する
-        root_max_row, root_max_col = root_df.shape
-
-    return root_df
+@app.on_event("startup")
+def start_scheduler():
+    """
+    アプリケーション起動時にプロセスプールを作成し、ワーカースレッドを開始する
+    """
+    global report_executor, uploader, formatter_streaming
+    if formatter_streaming and ijson is None:
+        print("ijson is not installed. FORMATTER_STREAMING is disabled.")
+        formatter_streaming = False
+    report_executor = create_report_executor()
+    uploader = MinioUploader.from_env()
+    scheduler.start()
 
 
 @app.post("/api/v1/resource", response_class=JSONResponse)
@@ -495,21 +1240,95 @@ async def process_resource(request: Request):
     content_type = request.headers.get("content-type")
     if content_type != 'application/json':
         print('content type is not application/json {}'.format(content_type))
-        return " ", 404
+        return JSONResponse(
+            status_code=415, content="content type is not application/json")
+
+    # 圧縮されたbody(Content-Encoding: gzip, deflate, zstd)は展開して受け取る
+    # 受け取ったjsonは、ストリーミングの場合はパースせずにバッファへ保存し、ワーカーで1件ずつ
+    # パースする。それ以外の場合はbodyのbytesを一度だけパースする
+    # (旧形式のjson文字列の場合はもう一度パース)
+    if formatter_streaming:
+        buffer = tempfile.SpooledTemporaryFile(
+            max_size=formatter_spool_max_size)
+    else:
+        buffer = io.BytesIO()
+    try:
+        writer = body_writer(
+            request.headers.get("content-encoding"), buffer,
+            formatter_max_body_size)
+    except ValueError as e:
+        buffer.close()
+        print(e)
+        return JSONResponse(status_code=415, content=str(e))
+
+    # キューが一杯の場合はbodyを読み込む前に503を返す
+    if scheduler.queue.full():
+        buffer.close()
+        return queue_full_response(filename)
 
-    # 受け取ったjsonをinputデータとして変数に格納
     try:
-        input = await request.json()
-    except json.JSONDecodeError as e:
+        async for chunk in request.stream():
+            if chunk:
+                writer.write(chunk)
+        writer.flush()
+        if formatter_streaming:
+            buffer.seek(0)
+            input = buffer
+        else:
+            input = parse_json(buffer.getvalue())
+            buffer.close()
+            if isinstance(input, str):
+                input = parse_json(input)
+    except BodyTooLargeError as e:
+        buffer.close()
+        print(e)
+        return JSONResponse(status_code=413, content=str(e))
+    except (ValueError,) + BODY_DECODE_ERRORS as e:
+        buffer.close()
         print(sys.exc_info())
         print(e)
-        return " ", 406
+        return JSONResponse(status_code=400, content="invalid body")
+
+    # ジョブをキューに追加。キューが一杯の場合は503を返す
+    job = Job(filename, input, output)
+    try:
+        scheduler.submit(job)
+    except queue.Full:
+        if hasattr(input, "close"):
+            input.close()
+        return queue_full_response(filename)
 
-    # スレッドを動的に作成
-    thread = Thread(filename, input, output)
-    thread.start()
+    # ジョブIDを返す。完了はGET /api/v1/jobs/{id}?wait=秒数 で待つことができる
+    return JSONResponse(
+        status_code=202,
+        content=job.to_dict(),
+        headers={"Location": "/api/v1/jobs/" + job.id})
+
+
+def queue_full_response(filename):
+    """
+    ジョブのキューが一杯の場合のレスポンス(503, Retry-After)を作成する
+    """
+    print(f"Job queue is full. {filename} was rejected.")
+    return JSONResponse(
+        status_code=503,
+        content="job queue is full",
+        headers={"Retry-After": str(formatter_retry_after)})
+
+
+@app.get("/api/v1/jobs/{id}", response_class=JSONResponse)
+def get_job(id: str, wait: float = 0):
+    """
+    ジョブの状態(queued, running, done, failed)と処理段階ごとの所要時間を返す
+    waitを指定した場合、ジョブが完了するまで最大wait秒(FORMATTER_MAX_WAITまで)待ってから返す
+    """
+    job = scheduler.get(id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    if wait > 0:
+        job.finished.wait(min(wait, formatter_max_wait))
+    return job.to_dict()
 
-    return "OK"
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8080, log_level="info")
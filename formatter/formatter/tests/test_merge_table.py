@@ -0,0 +1,154 @@
+# 行バッファへの展開・マージ結果が従来(DataFrameを逐次更新する実装)の
+# 出力と列・行の順序まで一致することを確認するテスト
+import functools
+import os
+import sys
+from unittest import mock
+
+# app.pyは読み込み時に標準入出力を開き直すため、pytestが置き換えたstdinを元に戻し、
+# 開き直したストリームが破棄されてもpytestの出力キャプチャを閉じないようにする
+sys.stdin = sys.__stdin__
+with mock.patch("os.fdopen", functools.partial(os.fdopen, closefd=False)):
+    from formatter import app
+
+KIND = "Deployment"
+APIVERSION = "apps/v1"
+
+# ネストした辞書、辞書のリスト、文字列のリスト、空の値を含むアイテム
+ITEMS = [
+    {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {
+            "name": "web",
+            "labels": {"app": "web", "tier": "front"},
+            "annotations": {},
+        },
+        "spec": {
+            "replicas": 2,
+            "template": {"spec": {"containers": [
+                {"name": "nginx", "image": "nginx:1.25",
+                 "args": ["--port", "80"],
+                 "ports": [{"containerPort": 80}]},
+                {"name": "sidecar", "image": "busybox",
+                 "env": []},
+            ]}},
+        },
+        "status": None,
+    },
+    {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {
+            "name": "api",
+            "labels": {"app": "api"},
+            "namespace": "",
+        },
+        "spec": {
+            "replicas": 1,
+            "template": {"spec": {"containers": [
+                {"name": "app", "image": "api:2",
+                 "args": ["serve"],
+                 "ports": [{"containerPort": 8080},
+                           {"containerPort": 9090, "name": "metrics"}]},
+            ]}},
+            "paused": True,
+        },
+    },
+    {
+        "metadata": {"name": "empty", "labels": {}},
+        "spec": {},
+    },
+]
+
+# 従来の実装(make_list + df_merge)で上記のITEMSから生成した出力
+GOLDEN_COLUMNS = [
+    "key1", "key2", "key3", "key4", "key5", "key6",
+    "Deployment1", "Deployment2", "Deployment3",
+]
+GOLDEN_ROWS = [
+    ("kind", "", "", "", "", "",
+     "Deployment", "Deployment", "Deployment"),
+    ("apiVersion", "", "", "", "", "",
+     "apps/v1", "apps/v1", "apps/v1"),
+    ("metadata", "name", "", "", "", "",
+     "web", "api", "empty"),
+    ("metadata", "labels", "app", "", "", "",
+     "web", "api", {}),
+    ("metadata", "labels", "tier", "", "", "",
+     "front", "", ""),
+    ("metadata", "annotations", "", "", "", "",
+     {}, "", ""),
+    ("metadata", "namespace", "", "", "", "",
+     "", "", ""),
+    ("spec", "replicas", "", "", "", "",
+     2, 1, {}),
+    ("spec", "template", "spec", "containers", "name(1)", "",
+     "nginx", "app", ""),
+    ("spec", "template", "spec", "containers", "image(1)", "",
+     "nginx:1.25", "api:2", ""),
+    ("spec", "template", "spec", "containers", "args(1)", "",
+     "['--port', '80']", "['serve']", ""),
+    ("spec", "template", "spec", "containers", "ports(1)",
+     "containerPort(1)", 80, 8080, ""),
+    ("spec", "template", "spec", "containers", "ports(1)",
+     "containerPort(2)", "", 9090, ""),
+    ("spec", "template", "spec", "containers", "ports(1)",
+     "name(2)", "", "metrics", ""),
+    ("spec", "template", "spec", "containers", "name(2)", "",
+     "sidecar", "", ""),
+    ("spec", "template", "spec", "containers", "image(2)", "",
+     "busybox", "", ""),
+    ("spec", "paused", "", "", "", "",
+     "", True, ""),
+    ("status", "", "", "", "", "",
+     "null", "", ""),
+]
+
+
+def dataframe_rows(df):
+    """
+    DataFrameの各行をtupleのリストにして返す
+    """
+    return [tuple(row) for row in df.itertuples(index=False)]
+
+
+def test_merge_table_matches_golden():
+    """
+    flatten_item + MergeTable.mergeの結果が従来の出力と一致すること
+    """
+    table = app.MergeTable(KIND)
+    for item in ITEMS:
+        table.merge(*app.flatten_item(item, KIND, APIVERSION))
+
+    df = table.to_dataframe()
+    assert list(df.columns) == GOLDEN_COLUMNS
+    assert dataframe_rows(df) == GOLDEN_ROWS
+
+
+def test_flatten_items_matches_flatten_item():
+    """
+    プロセスプール用のflatten_itemsがアイテムごとのflatten_itemと同じ結果を返すこと
+    """
+    assert app.flatten_items(ITEMS, KIND, APIVERSION) == [
+        app.flatten_item(item, KIND, APIVERSION) for item in ITEMS]
+
+
+def test_make_list_and_df_merge_match_golden():
+    """
+    互換用のmake_list / df_mergeを従来と同じ手順で呼んだ結果が一致すること
+    """
+    df = app.make_list(ITEMS[0], KIND, APIVERSION)
+    for kind_num, item in enumerate(ITEMS[1:], start=2):
+        df = app.df_merge(
+            df, app.make_list(item, KIND, APIVERSION), kind_num, KIND)
+
+    assert list(df.columns) == GOLDEN_COLUMNS
+    assert dataframe_rows(df) == GOLDEN_ROWS
+
+
+def test_empty_items():
+    """
+    アイテムが無い場合は空のDataFrameになること
+    """
+    assert app.MergeTable(KIND).to_dataframe().empty